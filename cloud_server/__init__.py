@@ -0,0 +1 @@
+"""Modules for the cloud server."""
@@ -1,8 +1,12 @@
 """Entrypoint for the message processing package for the cloud server."""
 import argparse
+import signal
+from types import FrameType
 from message_processing.message_saver import MessageSaver
 from message_processing.processing_client import ProcessingClient
-from typing import TypedDict, List
+from message_processing.face_index import (
+    FaceDeduplicator, FaceEmbedder, FaceIndex)
+from typing import TypedDict, List, Optional
 
 
 class MessageProcessingRunner:
@@ -14,16 +18,41 @@ class MessageProcessingRunner:
             resource_crn: str,
             broker_host: str,
             broker_port: int,
-            message_channel: str) -> None:
-        """Initialize the MessageProcessingRunner."""
+            message_channel: str,
+            embedding_model: Optional[str] = None,
+            similarity_threshold: float = 0.8,
+            dedup_window: int = 10000,
+            approximate_index: bool = False,
+            skip_duplicates: bool = False,
+            drain_timeout: float = 8.0,
+            max_queued_uploads: int = 100) -> None:
+        """Initialize the MessageProcessingRunner.
+
+        Faces are only grouped by identity if embedding_model is given.
+        """
         message_saver = MessageSaver(api_key, resource_crn)
+        deduplicator: Optional[FaceDeduplicator] = None
+        if (embedding_model is not None):
+            embedder = FaceEmbedder(embedding_model)
+            index = FaceIndex(
+                embedder.dimension, similarity_threshold, dedup_window,
+                approximate_index)
+            deduplicator = FaceDeduplicator(embedder, index, skip_duplicates)
         self._processing_client = ProcessingClient(
-            broker_host, broker_port, message_channel, message_saver)
+            broker_host, broker_port, message_channel, message_saver,
+            deduplicator, max_queued_uploads)
+        self._drain_timeout = drain_timeout
 
     def run(self) -> None:
-        """Run the message processing client."""
+        """Run the message processing client until stopped by a signal."""
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
         print('Starting message processing.')
-        self._processing_client.start()
+        self._processing_client.start(self._drain_timeout)
+
+    def _stop(self, signal_number: int, _: Optional[FrameType]) -> None:
+        print(f'Received signal {signal_number}. Stopping processing...')
+        self._processing_client.stop()
 
 
 if(__name__ == "__main__"):
@@ -44,11 +73,39 @@ if(__name__ == "__main__"):
     arg_parser.add_argument(
         '-c', '--channel', type=str, default='faces',
         help='Channel to subscribe to for incoming messages.')
+    arg_parser.add_argument(
+        '-e', '--embedding_model', type=str,
+        help='Face embedding model used to group faces by identity.')
+    arg_parser.add_argument(
+        '--similarity_threshold', type=float, default=0.8,
+        help='Minimum cosine similarity for faces to share an identity.')
+    arg_parser.add_argument(
+        '--dedup_window', type=int, default=10000,
+        help='Number of recent faces compared against.')
+    arg_parser.add_argument(
+        '--approximate_index', action='store_true',
+        help='Use hashing instead of comparing against every recent face.')
+    arg_parser.add_argument(
+        '--skip_duplicates', action='store_true',
+        help='Skip storing faces that match a recent identity.')
+    arg_parser.add_argument(
+        '--drain_timeout', type=float, default=8.0,
+        help='Seconds to wait for queued uploads on shutdown.')
+    arg_parser.add_argument(
+        '--max_queued_uploads', type=int, default=100,
+        help='Uploads queued before receiving messages pauses.')
     args = arg_parser.parse_args()
     runner = MessageProcessingRunner(
         args.api_key,
         args.crn,
         args.broker,
         args.port,
-        args.channel)
+        args.channel,
+        args.embedding_model,
+        args.similarity_threshold,
+        args.dedup_window,
+        args.approximate_index,
+        args.skip_duplicates,
+        args.drain_timeout,
+        args.max_queued_uploads)
     runner.run()
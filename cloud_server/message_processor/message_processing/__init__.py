@@ -1,3 +1,4 @@
 """Package for reading messages from broker and saving to Cloud Storage."""
 from . import processing_client
 from . import message_saver
+from . import face_index
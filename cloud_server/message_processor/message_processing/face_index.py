@@ -0,0 +1,226 @@
+"""Module to group received faces by identity using face embeddings."""
+import numpy as np
+import cv2 as cv
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple
+from uuid import uuid4
+
+
+class FaceMatch(NamedTuple):
+    """Result of adding a face to the index.
+
+    Attributes:
+        identity: identity key the face was assigned to.
+        similarity: cosine similarity to the closest face in the window,
+            or 0.0 if the window was empty.
+        is_duplicate: whether the face matched an identity in the window.
+    """
+
+    identity: str
+    similarity: float
+    is_duplicate: bool
+
+
+class FaceEmbedder:
+    """Computes face embeddings on CPU with an OpenCV dnn model."""
+
+    def __init__(
+            self,
+            model_path: str,
+            input_size: Tuple[int, int] = (96, 96),
+            scale_factor: float = 1 / 255.0) -> None:
+        """Load the embedding model.
+
+        Args:
+            model_path: path to the embedding model, e.g. the OpenFace
+                nn4.small2.v1.t7 Torch model.
+            input_size: (width, height) faces are resized to.
+                Defaults to (96, 96).
+            scale_factor: multiplier applied to pixels.
+                Defaults to 1 / 255.
+        """
+        self._net = cv.dnn.readNet(model_path)
+        self._net.setPreferableBackend(cv.dnn.DNN_BACKEND_OPENCV)
+        self._net.setPreferableTarget(cv.dnn.DNN_TARGET_CPU)
+        self._input_size = input_size
+        self._scale_factor = scale_factor
+        blank_face = np.zeros(
+            (input_size[1], input_size[0], 3), dtype=np.uint8)
+        self.dimension = self._forward(blank_face).shape[0]
+
+    def embed(self, message: bytes) -> Optional[np.ndarray]:
+        """Return the embedding of an encoded face image.
+
+        Args:
+            message: encoded face image, e.g. PNG bytes.
+
+        Returns:
+            the embedding, or None if the image cannot be decoded.
+        """
+        face = cv.imdecode(
+            np.frombuffer(message, dtype=np.uint8), cv.IMREAD_COLOR)
+        if (face is None):
+            return None
+        return self._forward(face)
+
+    def _forward(self, face: np.ndarray) -> np.ndarray:
+        blob = cv.dnn.blobFromImage(
+            face, self._scale_factor, self._input_size, (0, 0, 0),
+            swapRB=True, crop=False)
+        self._net.setInput(blob)
+        embedding: np.ndarray = self._net.forward().flatten()
+        return embedding.astype(np.float32)
+
+
+class FaceIndex:
+    """In-memory index of the most recent face embeddings.
+
+    Faces are compared by cosine similarity against a sliding window of the
+    last window_size faces. The exact mode compares against the whole
+    window with one matrix product. The approximate mode uses random
+    hyperplane hashing and only compares against faces that share a hash
+    bucket in at least one table.
+    """
+
+    def __init__(
+            self,
+            dimension: int,
+            similarity_threshold: float = 0.8,
+            window_size: int = 10000,
+            approximate: bool = False,
+            hash_tables: int = 4,
+            hash_bits: int = 8,
+            seed: int = 0) -> None:
+        """Initialize an empty index.
+
+        Args:
+            dimension: size of the embeddings.
+            similarity_threshold: minimum cosine similarity for two faces to
+                share an identity. Defaults to 0.8.
+            window_size: number of recent faces kept in the index.
+                Defaults to 10000.
+            approximate: use hashing to limit comparisons.
+                Defaults to False.
+            hash_tables: number of hash tables in approximate mode.
+                Defaults to 4.
+            hash_bits: hyperplanes per hash table in approximate mode.
+                Defaults to 8.
+            seed: seed for the random hyperplanes. Defaults to 0.
+        """
+        self.similarity_threshold = similarity_threshold
+        self.window_size = window_size
+        self.approximate = approximate
+        self._embeddings = np.zeros((window_size, dimension), np.float32)
+        self._identities: List[str] = [''] * window_size
+        self._count = 0
+        self._next_slot = 0
+        planes = np.random.default_rng(seed).standard_normal(
+            (hash_tables, hash_bits, dimension))
+        self._planes = planes.astype(np.float32)
+        self._bit_values = 1 << np.arange(hash_bits)
+        self._buckets: List[Dict[int, Set[int]]] = [
+            {} for _ in range(hash_tables)]
+        self._slot_keys: List[Optional[np.ndarray]] = [None] * window_size
+
+    def __len__(self) -> int:
+        """Return number of faces in the window."""
+        return self._count
+
+    def add(self, embedding: np.ndarray) -> FaceMatch:
+        """Add a face to the index and return the identity it belongs to.
+
+        Args:
+            embedding: embedding of the face.
+
+        Returns:
+            the identity of the closest face in the window if it is similar
+            enough, else a new identity.
+        """
+        norm = np.linalg.norm(embedding)
+        normalized = (embedding / norm if norm > 0 else embedding).astype(
+            np.float32)
+        keys = self._hash(normalized) if self.approximate else None
+        slot, similarity = self._find_closest(normalized, keys)
+        if (slot is not None and similarity >= self.similarity_threshold):
+            match = FaceMatch(self._identities[slot], similarity, True)
+        else:
+            match = FaceMatch(str(uuid4()), similarity, False)
+        self._insert(normalized, match.identity, keys)
+        return match
+
+    def _find_closest(
+            self,
+            embedding: np.ndarray,
+            keys: Optional[np.ndarray]) -> Tuple[Optional[int], float]:
+        candidates: np.ndarray
+        if (keys is None):
+            candidates = np.arange(self._count)
+        else:
+            slots: Set[int] = set()
+            for table, key in enumerate(keys):
+                slots.update(self._buckets[table].get(int(key), set()))
+            candidates = np.fromiter(slots, dtype=np.int64, count=len(slots))
+        if (len(candidates) == 0):
+            return None, 0.0
+        similarities = self._embeddings[candidates] @ embedding
+        best = int(np.argmax(similarities))
+        return int(candidates[best]), float(similarities[best])
+
+    def _insert(
+            self,
+            embedding: np.ndarray,
+            identity: str,
+            keys: Optional[np.ndarray]) -> None:
+        slot = self._next_slot
+        old_keys = self._slot_keys[slot]
+        if (old_keys is not None):
+            for table, key in enumerate(old_keys):
+                self._buckets[table][int(key)].discard(slot)
+        self._embeddings[slot] = embedding
+        self._identities[slot] = identity
+        self._slot_keys[slot] = keys
+        if (keys is not None):
+            for table, key in enumerate(keys):
+                self._buckets[table].setdefault(int(key), set()).add(slot)
+        self._next_slot = (slot + 1) % self.window_size
+        self._count = min(self._count + 1, self.window_size)
+
+    def _hash(self, embedding: np.ndarray) -> np.ndarray:
+        bits = (self._planes @ embedding) > 0
+        keys: np.ndarray = bits @ self._bit_values
+        return keys
+
+
+class FaceDeduplicator:
+    """Assigns received faces to identities and flags near-duplicates."""
+
+    def __init__(
+            self,
+            embedder: FaceEmbedder,
+            index: FaceIndex,
+            skip_duplicates: bool = False) -> None:
+        """Initialize the deduplicator.
+
+        Args:
+            embedder: model used to embed received faces.
+            index: index of recent faces.
+            skip_duplicates: whether faces matching an identity in the
+                window should be skipped rather than stored under it.
+                Defaults to False.
+        """
+        self._embedder = embedder
+        self._index = index
+        self.skip_duplicates = skip_duplicates
+
+    def match(self, message: bytes) -> Optional[FaceMatch]:
+        """Match a received face against recent faces.
+
+        Args:
+            message: encoded face image.
+
+        Returns:
+            the match, or None if the image could not be decoded.
+        """
+        embedding = self._embedder.embed(message)
+        if (embedding is None):
+            return None
+        return self._index.add(embedding)
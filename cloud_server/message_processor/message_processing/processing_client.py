@@ -1,7 +1,11 @@
 """Module exposing messaging client to read messages and save them."""
+import queue
+import threading
+import time
 import paho.mqtt.client as mqtt
-from typing import Dict
+from typing import Dict, Optional, Tuple
 from .message_saver import MessageSaver
+from .face_index import FaceDeduplicator
 from uuid import uuid4, UUID
 
 
@@ -13,8 +17,19 @@ class ProcessingClient:
             broker_host: str,
             broker_port: int,
             channel: str,
-            message_saver: MessageSaver) -> None:
-        """Initialize the client."""
+            message_saver: MessageSaver,
+            deduplicator: Optional[FaceDeduplicator] = None,
+            max_queued_uploads: int = 100) -> None:
+        """Initialize the client.
+
+        If a deduplicator is given, faces are stored under
+        <identity>/<object id> so faces of the same person are grouped, and
+        near-duplicates are skipped if the deduplicator is set to.
+        Once max_queued_uploads messages wait for upload, receiving blocks
+        until an upload finishes, so a slow object storage slows down
+        intake instead of growing memory. Messages that arrive to a full
+        queue after stop is called are abandoned.
+        """
         self._host = broker_host
         self._port = broker_port
         self._channel = channel
@@ -22,6 +37,18 @@ class ProcessingClient:
         self._client.on_connect = self._on_connect
         self._client.on_message = self._on_message
         self._message_saver = message_saver
+        self._deduplicator = deduplicator
+        # uploads run on their own thread so a slow upload does not block
+        # the network loop, and can be drained on shutdown
+        self._uploads: 'queue.Queue[Optional[bytes]]' = queue.Queue(
+            max_queued_uploads)
+        self._pending_lock = threading.Lock()
+        self._pending_uploads = 0
+        self._dropped_uploads = 0
+        self._upload_worker = threading.Thread(
+            target=self._process_uploads, daemon=True)
+        self._upload_worker.start()
+        self._stop_requested = False
 
     def _on_connect(
             self,
@@ -38,15 +65,101 @@ class ProcessingClient:
             _: mqtt.Client,
             __: Dict[str, str],
             message: mqtt.MQTTMessage) -> None:
+        print('Received message. Queued for processing.')
+        with self._pending_lock:
+            self._pending_uploads += 1
+        # wait for room in short steps so a stop request is noticed and
+        # loop_stop does not wait for an upload to finish
+        while (not self._stop_requested):
+            try:
+                self._uploads.put(message.payload, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+        try:
+            self._uploads.put_nowait(message.payload)
+        except queue.Full:
+            with self._pending_lock:
+                self._pending_uploads -= 1
+                self._dropped_uploads += 1
+
+    def _process_uploads(self) -> None:
+        while (True):
+            payload = self._uploads.get()
+            if (payload is None):
+                return
+            try:
+                self._process_message(payload)
+            except Exception as error:
+                print(f'Failed to process message: {error}')
+            finally:
+                with self._pending_lock:
+                    self._pending_uploads -= 1
+
+    def _process_message(self, payload: bytes) -> None:
         object_name: str = str(uuid4())
-        print('Received message. Processing...')
+        print('Processing message...')
+        if (self._deduplicator is not None):
+            match = self._deduplicator.match(payload)
+            if (match is None):
+                print('Could not decode face, storing without identity.')
+            elif (match.is_duplicate and self._deduplicator.skip_duplicates):
+                print(f'Skipping duplicate of identity {match.identity} '
+                      f'(similarity={match.similarity:.2f}).')
+                return
+            else:
+                object_name = f'{match.identity}/{object_name}'
         self._message_saver.store_object(
-            message.payload, object_name, self._channel)
+            payload, object_name, self._channel)
         print('Message processed successfully.')
 
-    def start(self) -> None:
-        """Subscribe to messaging server and start processing."""
+    def start(self, drain_timeout: float = 8.0) -> None:
+        """Subscribe to messaging server and start processing.
+
+        Returns after stop is called, once queued uploads are done or
+        drain_timeout seconds have passed since stop was noticed.
+        """
         print('Connecting to message broker...')
         self._client.connect(self._host, self._port)
         print('Connected. Starting loop...')
-        self._client.loop_forever()
+        self._client.loop_start()
+        while (not self._stop_requested):
+            time.sleep(0.1)
+        deadline = time.monotonic() + drain_timeout
+        # disconnect here rather than in stop: paho takes locks the
+        # interrupted thread may already hold
+        self._client.disconnect()
+        self._client.loop_stop()
+        self.drain(max(deadline - time.monotonic(), 0.0))
+
+    def stop(self) -> None:
+        """Stop receiving messages so start drains and returns.
+
+        Only sets a flag, so it is safe to call from a signal handler.
+        """
+        self._stop_requested = True
+
+    def drain(self, timeout: float) -> Tuple[int, int]:
+        """Finish queued uploads and stop the upload thread.
+
+        Args:
+            timeout: maximum seconds to wait.
+
+        Returns:
+            tuple of (flushed, abandoned) upload counts. Messages dropped
+            because the queue was full while stopping count as abandoned.
+        """
+        with self._pending_lock:
+            pending = self._pending_uploads
+        deadline = time.monotonic() + timeout
+        try:
+            self._uploads.put(None, timeout=timeout)
+        except queue.Full:
+            pass
+        self._upload_worker.join(max(deadline - time.monotonic(), 0.0))
+        with self._pending_lock:
+            abandoned = self._pending_uploads + self._dropped_uploads
+            pending += self._dropped_uploads
+        print(f'Upload queue drained: {pending - abandoned} uploads '
+              f'flushed, {abandoned} abandoned.')
+        return pending - abandoned, abandoned
@@ -0,0 +1,191 @@
+"""Benchmark the neural face detector inference backends on CPU."""
+import argparse
+import multiprocessing as mp
+import queue
+import resource
+import time
+from typing import Dict, List, Tuple, Union
+import numpy as np
+import cv2 as cv
+from face_detection.neural_face_detector import NeuralFaceDetector
+
+BenchmarkResult = Dict[str, Union[str, float, List[List[float]]]]
+
+
+def _peak_memory_mb() -> float:
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def _run_benchmark(
+        name: str,
+        backend: str,
+        model_path: str,
+        config_path: str,
+        image_path: str,
+        input_size: Tuple[int, int],
+        runs: int,
+        threads: int,
+        dnn_scale_factor: float,
+        dnn_mean: Tuple[float, float, float],
+        results: 'mp.Queue[BenchmarkResult]') -> None:
+    """Benchmark one backend. Runs in its own process to isolate memory.
+
+    Failures are reported as a result with an error so the parent does not
+    wait for a result that never comes.
+    """
+    try:
+        results.put(_benchmark(
+            name, backend, model_path, config_path, image_path, input_size,
+            runs, threads, dnn_scale_factor, dnn_mean))
+    except Exception as error:
+        results.put({'name': name, 'error': repr(error)})
+
+
+def _benchmark(
+        name: str,
+        backend: str,
+        model_path: str,
+        config_path: str,
+        image_path: str,
+        input_size: Tuple[int, int],
+        runs: int,
+        threads: int,
+        dnn_scale_factor: float,
+        dnn_mean: Tuple[float, float, float]) -> BenchmarkResult:
+    memory_before = _peak_memory_mb()
+    load_start = time.perf_counter()
+    detector = NeuralFaceDetector(
+        model_path, input_size, backend=backend, config_path=config_path,
+        intra_op_threads=threads, warmup_runs=1,
+        dnn_scale_factor=dnn_scale_factor, dnn_mean=dnn_mean)
+    load_time = time.perf_counter() - load_start
+    image = cv.imread(image_path)
+    if (image is None):
+        raise FileNotFoundError(f'Could not read image {image_path}')
+    latencies: List[float] = []
+    faces: List[List[int]] = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        faces = detector.get_faces(image)
+        latencies.append(time.perf_counter() - start)
+    return {
+        'name': name,
+        'load_s': load_time,
+        'median_ms': float(np.median(latencies)) * 1000,
+        'p95_ms': float(np.percentile(latencies, 95)) * 1000,
+        'peak_memory_mb': _peak_memory_mb(),
+        'model_memory_mb': _peak_memory_mb() - memory_before,
+        'faces': [[float(value) for value in face] for face in faces]
+    }
+
+
+def _wait_for_result(
+        name: str,
+        process: mp.process.BaseProcess,
+        results: 'mp.Queue[BenchmarkResult]') -> BenchmarkResult:
+    # a child killed by a crash never puts a result, so keep checking it
+    while (True):
+        try:
+            return results.get(timeout=1.0)
+        except queue.Empty:
+            if (process.is_alive()):
+                continue
+        try:
+            # the result may have arrived just before the child exited
+            return results.get(timeout=1.0)
+        except queue.Empty:
+            return {'name': name,
+                    'error': f'process exited with code {process.exitcode}'}
+
+
+def _max_box_difference(
+        faces: List[List[float]],
+        reference: List[List[float]]) -> float:
+    if (len(faces) != len(reference)):
+        return float('inf')
+    if (len(faces) == 0):
+        return 0.0
+    return float(np.max(np.abs(np.array(faces) - np.array(reference))))
+
+
+if(__name__ == "__main__"):
+    arg_parser = argparse.ArgumentParser(
+        description='Compare neural face detector backends on CPU.')
+    arg_parser.add_argument(
+        '-i', '--image', type=str, required=True,
+        help='Image to run detection on.')
+    arg_parser.add_argument(
+        '--width', type=int, default=300,
+        help='Input image width for detector.')
+    arg_parser.add_argument(
+        '--height', type=int, default=300,
+        help='Input image height for detector.')
+    arg_parser.add_argument(
+        '-r', '--runs', type=int, default=50,
+        help='Number of timed inferences per backend.')
+    arg_parser.add_argument(
+        '-t', '--threads', type=int, default=0,
+        help='Threads per backend (0 = runtime default).')
+    arg_parser.add_argument(
+        '--tensorflow_model', type=str,
+        help='Frozen graph for the tensorflow backend.')
+    arg_parser.add_argument(
+        '--tflite_model', type=str,
+        help='Float model for the tflite backend.')
+    arg_parser.add_argument(
+        '--tflite_quantized_model', type=str,
+        help='Quantized model for the tflite backend.')
+    arg_parser.add_argument(
+        '--opencv_model', type=str,
+        help='Model weights for the opencv backend.')
+    arg_parser.add_argument(
+        '--opencv_config', type=str, default='',
+        help='Network description for the opencv backend.')
+    arg_parser.add_argument(
+        '--opencv_scale_factor', type=float, default=1.0,
+        help='Multiplier applied to pixels by the opencv backend.')
+    arg_parser.add_argument(
+        '--opencv_mean', type=float, nargs=3, default=[0.0, 0.0, 0.0],
+        help='Per-channel mean subtracted by the opencv backend '
+             '(104 177 123 for res10).')
+    args = arg_parser.parse_args()
+
+    candidates = [
+        ('tensorflow', 'tensorflow', args.tensorflow_model, ''),
+        ('tflite', 'tflite', args.tflite_model, ''),
+        ('tflite-quantized', 'tflite', args.tflite_quantized_model, ''),
+        ('opencv', 'opencv', args.opencv_model, args.opencv_config)]
+    context = mp.get_context('spawn')
+    result_queue: 'mp.Queue[BenchmarkResult]' = context.Queue()
+    benchmarks: List[BenchmarkResult] = []
+    for name, backend, model_path, config_path in candidates:
+        if (model_path is None):
+            continue
+        process = context.Process(
+            target=_run_benchmark,
+            args=(name, backend, model_path, config_path, args.image,
+                  (args.width, args.height), args.runs, args.threads,
+                  args.opencv_scale_factor, tuple(args.opencv_mean),
+                  result_queue))
+        process.start()
+        result = _wait_for_result(name, process, result_queue)
+        process.join()
+        if ('error' in result):
+            print(f'Skipping {name}: {result["error"]}')
+            continue
+        benchmarks.append(result)
+
+    assert len(benchmarks) > 0, 'No backend could be benchmarked.'
+    reference_faces = benchmarks[0]['faces']
+    print(f'{"backend":<18}{"load s":>8}{"median ms":>11}{"p95 ms":>9}'
+          f'{"peak MB":>9}{"model MB":>10}{"faces":>7}{"max box diff":>14}')
+    for benchmark in benchmarks:
+        faces = benchmark['faces']
+        assert isinstance(faces, list) and isinstance(reference_faces, list)
+        difference = _max_box_difference(faces, reference_faces)
+        print(f'{benchmark["name"]:<18}{benchmark["load_s"]:>8.2f}'
+              f'{benchmark["median_ms"]:>11.1f}{benchmark["p95_ms"]:>9.1f}'
+              f'{benchmark["peak_memory_mb"]:>9.0f}'
+              f'{benchmark["model_memory_mb"]:>10.0f}'
+              f'{len(faces):>7}{difference:>14.1f}')
@@ -3,3 +3,8 @@ from . import face_detector
 from . import messaging_client
 from . import video_streamer
 from . import neural_face_detector
+from . import inference_backend
+from . import face_cropper
+from . import publish_controller
+from . import batch_processor
+from . import detection_filter
@@ -0,0 +1,332 @@
+"""Module to detect faces in recorded video files with a process pool."""
+import json
+import multiprocessing as mp
+import os
+import pathlib
+import time
+from collections import deque
+from multiprocessing.pool import AsyncResult
+from typing import (
+    Callable, Deque, Dict, Generator, List, NamedTuple, Optional)
+import numpy as np
+import cv2 as cv
+from .face_detector import IFaceDetector
+from .face_cropper import FaceCropper
+from .messaging_client import IMessagingClient
+
+
+class FrameRange(NamedTuple):
+    """Range of frames in a video processed by one worker task.
+
+    Attributes:
+        video_index: position of the video in the batch.
+        video_path: path to the video file.
+        start: first frame of the range.
+        end: frame after the last frame of the range, or -1 to read until
+            the end of the video.
+    """
+
+    video_index: int
+    video_path: str
+    start: int
+    end: int
+
+
+class FaceRecord(NamedTuple):
+    """A face found in a video.
+
+    Attributes:
+        video_path: path to the video file.
+        frame: index of the frame the face was found in.
+        face: index of the face within the frame.
+        box: face coordinates (x, y, w, h) after margin and clamping.
+        file: crop path relative to the output directory, if written.
+        image: encoded crop, if it was not written to a file.
+    """
+
+    video_path: str
+    frame: int
+    face: int
+    box: List[int]
+    file: Optional[str]
+    image: Optional[bytes]
+
+
+_worker_detector_factory: Optional[Callable[[], IFaceDetector]] = None
+_worker_detector: Optional[IFaceDetector] = None
+_worker_cropper: Optional[FaceCropper] = None
+
+
+def _init_worker(
+        detector_factory: Callable[[], IFaceDetector],
+        crop_margin: float,
+        pad_crops: bool) -> None:
+    global _worker_detector_factory, _worker_cropper
+    _worker_detector_factory = detector_factory
+    _worker_cropper = FaceCropper(crop_margin, pad_crops)
+
+
+def _process_range(
+        frame_range: FrameRange,
+        output_dir: Optional[str]) -> List[FaceRecord]:
+    global _worker_detector
+    assert _worker_detector_factory is not None
+    assert _worker_cropper is not None
+    if (_worker_detector is None):
+        # created on the first task rather than in the pool initializer,
+        # where a failure would make the pool respawn workers forever
+        _worker_detector = _worker_detector_factory()
+    video_name = f'{frame_range.video_index:04d}_' + \
+        pathlib.Path(frame_range.video_path).stem
+    if (output_dir is not None):
+        os.makedirs(os.path.join(output_dir, video_name), exist_ok=True)
+    capture = cv.VideoCapture(frame_range.video_path)
+    if (frame_range.start > 0):
+        capture.set(cv.CAP_PROP_POS_FRAMES, frame_range.start)
+    records: List[FaceRecord] = []
+    frame_index = frame_range.start
+    while (frame_range.end < 0 or frame_index < frame_range.end):
+        read_successful: bool
+        frame: np.ndarray
+        read_successful, frame = capture.read()
+        if (not read_successful):
+            break
+        faces = _worker_detector.get_faces(frame)
+        for face_index, face in enumerate(faces):
+            cut_image = _worker_cropper.crop(frame, face)
+            if (cut_image is None):
+                continue
+            box = list(_worker_cropper.get_box(face, frame.shape))
+            box = [box[0], box[1], box[2] - box[0], box[3] - box[1]]
+            encoded = _worker_cropper.encode(cut_image)
+            if (output_dir is None):
+                records.append(FaceRecord(
+                    frame_range.video_path, frame_index, face_index, box,
+                    None, bytes(encoded)))
+                continue
+            file_name = os.path.join(
+                video_name,
+                f'{frame_index:08d}_{face_index:02d}'
+                f'{_worker_cropper.image_format}')
+            with open(os.path.join(output_dir, file_name), 'wb') as file:
+                file.write(encoded)
+            records.append(FaceRecord(
+                frame_range.video_path, frame_index, face_index, box,
+                file_name, None))
+        frame_index += 1
+    capture.release()
+    return records
+
+
+class BatchProcessor:
+    """Detects faces in video files using a pool of detector processes.
+
+    Videos are split into frame ranges that workers seek to independently.
+    Results are collected in range order, so the output is the same for
+    any number of workers. Only max_in_flight ranges are submitted ahead of
+    the range being consumed, so a slow consumer bounds the memory used by
+    finished results.
+    """
+
+    def __init__(
+            self,
+            detector_factory: Callable[[], IFaceDetector],
+            workers: Optional[int] = None,
+            chunk_size: int = 300,
+            crop_margin: float = 0.0,
+            pad_crops: bool = False,
+            max_in_flight: int = 0) -> None:
+        """Initialize the processor.
+
+        Args:
+            detector_factory: picklable callable that creates the detector
+                used in each worker, e.g. functools.partial of a detector
+                class.
+            workers: number of worker processes.
+                Defaults to None (one per core).
+            chunk_size: number of frames per worker task. Defaults to 300.
+            crop_margin: fraction of the face width and height added on
+                each side of a face. Defaults to 0.0.
+            pad_crops: pad faces past the frame edge instead of clamping.
+                Defaults to False.
+            max_in_flight: maximum number of ranges submitted to the pool
+                but not yet consumed. Defaults to 0 (two per worker).
+        """
+        self.detector_factory = detector_factory
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.crop_margin = crop_margin
+        self.pad_crops = pad_crops
+        self.max_in_flight = max_in_flight
+
+    def split(self, video_paths: List[str]) -> List[FrameRange]:
+        """Split videos into frame ranges of at most chunk_size frames.
+
+        Videos whose frame count cannot be read are kept as one range.
+        """
+        frame_ranges: List[FrameRange] = []
+        for video_index, video_path in enumerate(video_paths):
+            capture = cv.VideoCapture(video_path)
+            if (not capture.isOpened()):
+                raise FileNotFoundError(f'Could not open video {video_path}')
+            frame_count = int(capture.get(cv.CAP_PROP_FRAME_COUNT))
+            capture.release()
+            if (frame_count <= 0):
+                frame_ranges.append(FrameRange(
+                    video_index, video_path, 0, -1))
+                continue
+            for start in range(0, frame_count, self.chunk_size):
+                end = min(start + self.chunk_size, frame_count)
+                if (end == frame_count):
+                    # read to the end in case the reported count is short
+                    end = -1
+                frame_ranges.append(FrameRange(
+                    video_index, video_path, start, end))
+        return frame_ranges
+
+    def process(
+            self,
+            video_paths: List[str],
+            output_dir: Optional[str] = None) -> Generator[
+                FaceRecord, None, None]:
+        """Detect faces in videos.
+
+        Args:
+            video_paths: videos to process.
+            output_dir: directory to write crops to. If None, encoded crops
+                are returned on the records instead. Defaults to None.
+
+        Returns:
+            iterator over the faces found, ordered by video, frame and face.
+        """
+        frame_ranges = iter(self.split(video_paths))
+        workers = self.workers or os.cpu_count() or 1
+        max_in_flight = self.max_in_flight or 2 * workers
+        context = mp.get_context('spawn')
+        with context.Pool(
+                workers,
+                initializer=_init_worker,
+                initargs=(self.detector_factory,
+                          self.crop_margin,
+                          self.pad_crops)) as pool:
+            in_flight: Deque[AsyncResult[List[FaceRecord]]] = deque()
+            while (True):
+                while (len(in_flight) < max_in_flight):
+                    frame_range = next(frame_ranges, None)
+                    if (frame_range is None):
+                        break
+                    in_flight.append(pool.apply_async(
+                        _process_range, (frame_range, output_dir)))
+                if (len(in_flight) == 0):
+                    break
+                yield from in_flight.popleft().get()
+
+    def write_to_directory(
+            self,
+            video_paths: List[str],
+            output_dir: str,
+            index_name: str = 'index.jsonl') -> int:
+        """Write crops and a metadata index for videos to a directory.
+
+        Args:
+            video_paths: videos to process.
+            output_dir: directory to write crops and index to.
+            index_name: name of the index file, one JSON object per face.
+                Defaults to index.jsonl.
+
+        Returns:
+            number of faces written.
+        """
+        os.makedirs(output_dir, exist_ok=True)
+        face_count = 0
+        with open(os.path.join(output_dir, index_name), 'w') as index:
+            for record in self.process(video_paths, output_dir):
+                index.write(json.dumps(self._to_metadata(record)) + '\n')
+                face_count += 1
+        return face_count
+
+    def publish(
+            self,
+            video_paths: List[str],
+            messaging_client: IMessagingClient,
+            output_channel: str,
+            guarantee_level: int = 1,
+            index_path: Optional[str] = None,
+            max_pending: int = 1000,
+            timeout: float = 60.0) -> int:
+        """Publish crops for videos to a broker in order.
+
+        The messaging client must already be connecting and looping. Each
+        crop waits until the client is connected and has fewer than
+        max_pending unacknowledged messages, and is retried if the client
+        drops it, so only crops the client accepted are counted.
+
+        Args:
+            video_paths: videos to process.
+            messaging_client: client used to publish crops.
+            output_channel: channel to publish crops to.
+            guarantee_level: level of guarantee for message delivery.
+                Defaults to 1 (at least once).
+            index_path: file to write the metadata index to.
+                Defaults to None (no index).
+            max_pending: publishing pauses while this many messages wait to
+                be acknowledged. Defaults to 1000.
+            timeout: seconds publishing may stay paused before giving up.
+                Defaults to 60.
+
+        Returns:
+            number of faces accepted by the messaging client.
+
+        Raises:
+            TimeoutError: if a crop is not accepted within timeout, e.g.
+                because the broker is unreachable.
+        """
+        face_count = 0
+        index = open(index_path, 'w') if index_path is not None else None
+        records = self.process(video_paths)
+        try:
+            for record in records:
+                assert record.image is not None
+                self._publish_record(
+                    messaging_client, output_channel, record.image,
+                    guarantee_level, max_pending, timeout)
+                if (index is not None):
+                    index.write(json.dumps(self._to_metadata(record)) + '\n')
+                face_count += 1
+        finally:
+            # stops the pool if publishing failed
+            records.close()
+            if (index is not None):
+                index.close()
+        return face_count
+
+    @staticmethod
+    def _publish_record(
+            messaging_client: IMessagingClient,
+            output_channel: str,
+            image: bytes,
+            guarantee_level: int,
+            max_pending: int,
+            timeout: float) -> None:
+        deadline = time.monotonic() + timeout
+        while (True):
+            # paho drops QoS 0 messages while it is not connected
+            if (messaging_client.is_connected()
+                    and messaging_client.pending_count() < max_pending
+                    and messaging_client.publish(
+                        output_channel, image, guarantee_level)):
+                return
+            if (time.monotonic() >= deadline):
+                state = 'connected' if messaging_client.is_connected() \
+                    else 'not connected'
+                raise TimeoutError(
+                    f'Message not accepted after {timeout}s: client '
+                    f'{state}, {messaging_client.pending_count()} messages '
+                    f'not acknowledged.')
+            time.sleep(0.01)
+
+    @staticmethod
+    def _to_metadata(record: FaceRecord) -> Dict[str, object]:
+        metadata = record._asdict()
+        del metadata['image']
+        return dict(metadata)
@@ -0,0 +1,247 @@
+"""Post-processing and fusion stages for face detectors."""
+import numpy as np
+import cv2 as cv
+from typing import Callable, List, Optional, Tuple, Union
+from .face_detector import IFaceDetector, IScoredFaceDetector
+from .face_cropper import FaceCropper
+
+
+def non_max_suppression(
+        faces: np.ndarray,
+        scores: np.ndarray,
+        iou_threshold: float,
+        top_k: int = 0) -> np.ndarray:
+    """Return indices of faces kept by greedy non-maximum suppression.
+
+    Args:
+        faces: array of shape (N, 4) with face coordinates (x, y, w, h).
+        scores: array of shape (N,) with the score of each face.
+        iou_threshold: faces overlapping a higher scoring kept face by more
+            than this intersection over union are suppressed.
+        top_k: maximum number of faces to keep. Defaults to 0 (no limit).
+
+    Returns:
+        indices of the kept faces, highest score first.
+    """
+    if (len(faces) == 0):
+        return np.zeros(0, dtype=np.int64)
+    x_start = faces[:, 0]
+    y_start = faces[:, 1]
+    x_end = faces[:, 0] + faces[:, 2]
+    y_end = faces[:, 1] + faces[:, 3]
+    areas = faces[:, 2] * faces[:, 3]
+    order = np.argsort(-scores, kind='stable')
+    kept: List[int] = []
+    while (len(order) > 0 and (top_k <= 0 or len(kept) < top_k)):
+        best = order[0]
+        kept.append(int(best))
+        rest = order[1:]
+        overlap_width = np.clip(
+            np.minimum(x_end[best], x_end[rest])
+            - np.maximum(x_start[best], x_start[rest]), 0, None)
+        overlap_height = np.clip(
+            np.minimum(y_end[best], y_end[rest])
+            - np.maximum(y_start[best], y_start[rest]), 0, None)
+        intersection = overlap_width * overlap_height
+        union = areas[best] + areas[rest] - intersection
+        iou = np.divide(
+            intersection, union, out=np.zeros_like(intersection),
+            where=union > 0)
+        order = rest[iou <= iou_threshold]
+    return np.array(kept, dtype=np.int64)
+
+
+def _get_scored_faces(
+        detector: IFaceDetector,
+        image: Union[np.ndarray, str]) -> Tuple[np.ndarray, np.ndarray]:
+    """Return faces and scores, using face area for unscored detectors."""
+    if (isinstance(detector, IScoredFaceDetector)):
+        faces, scores = detector.get_scored_faces(image)
+        return (np.array(faces, dtype=np.float64).reshape(-1, 4),
+                np.array(scores, dtype=np.float64))
+    faces_array = np.array(
+        detector.get_faces(image), dtype=np.float64).reshape(-1, 4)
+    return faces_array, faces_array[:, 2] * faces_array[:, 3]
+
+
+class FilteredFaceDetector(IScoredFaceDetector):
+    """Removes overlapping, excess and tiny faces from another detector.
+
+    Faces are ranked by the wrapped detector's score if it reports one,
+    else by area.
+    """
+
+    def __init__(
+            self,
+            detector: IFaceDetector,
+            iou_threshold: float = 0.3,
+            top_k: int = 0,
+            min_size: int = 0) -> None:
+        """Initialize the filter.
+
+        Args:
+            detector: detector whose faces are filtered.
+            iou_threshold: intersection over union above which the lower
+                scoring of two faces is dropped. Defaults to 0.3.
+            top_k: maximum number of faces per image.
+                Defaults to 0 (no limit).
+            min_size: minimum width and height of a face in pixels.
+                Defaults to 0.
+        """
+        self.detector = detector
+        self.iou_threshold = iou_threshold
+        self.top_k = top_k
+        self.min_size = min_size
+
+    def get_faces(self, image: Union[np.ndarray, str]) -> List[List[int]]:
+        """
+        Return filtered faces for an image.
+
+        Args:
+            image: image to classify.
+                Either an image as an ndarray or path to an image on disk.
+
+        Returns:
+            array of tuples for coordinates of faces (x, y, w, h)
+        """
+        faces, _ = self.get_scored_faces(image)
+        return faces
+
+    def get_scored_faces(
+            self,
+            image: Union[np.ndarray, str]) -> Tuple[
+                List[List[int]], List[float]]:
+        """Return filtered faces for an image and their scores."""
+        faces, scores = _get_scored_faces(self.detector, image)
+        return self._filter(faces, scores)
+
+    def _filter(
+            self,
+            faces: np.ndarray,
+            scores: np.ndarray) -> Tuple[List[List[int]], List[float]]:
+        large_enough = (faces[:, 2] >= self.min_size) & \
+            (faces[:, 3] >= self.min_size)
+        faces, scores = faces[large_enough], scores[large_enough]
+        kept = non_max_suppression(
+            faces, scores, self.iou_threshold, self.top_k)
+        kept_faces: List[List[int]] = np.round(
+            faces[kept]).astype(int).tolist()
+        kept_scores: List[float] = scores[kept].tolist()
+        return kept_faces, kept_scores
+
+
+class CascadeFusionDetector(FilteredFaceDetector):
+    """Runs an expensive detector only around faces a cheap one proposes.
+
+    The candidate detector (e.g. a Haar cascade) runs on every frame. The
+    detector (e.g. NeuralFaceDetector) then runs on each candidate region,
+    expanded by a margin, and its faces are merged with non-maximum
+    suppression. Every full_frame_interval frames the detector runs on the
+    whole frame instead, to find faces the candidate detector misses.
+    """
+
+    def __init__(
+            self,
+            candidate_detector: IFaceDetector,
+            detector: IFaceDetector,
+            margin: float = 0.5,
+            full_frame_interval: int = 30,
+            iou_threshold: float = 0.3,
+            top_k: int = 0,
+            min_size: int = 0) -> None:
+        """Initialize the fused detector.
+
+        Args:
+            candidate_detector: cheap detector proposing face regions.
+            detector: detector confirming faces within the regions.
+            margin: fraction of the candidate width and height added on
+                each side of a region. Defaults to 0.5.
+            full_frame_interval: run the detector on the whole frame every
+                this many frames. Defaults to 30. 0 disables full frames.
+            iou_threshold: intersection over union above which the lower
+                scoring of two faces is dropped. Defaults to 0.3.
+            top_k: maximum number of faces per image.
+                Defaults to 0 (no limit).
+            min_size: minimum width and height of a face in pixels.
+                Defaults to 0.
+        """
+        super().__init__(detector, iou_threshold, top_k, min_size)
+        self.candidate_detector = candidate_detector
+        self.full_frame_interval = full_frame_interval
+        self._region_cropper = FaceCropper(margin)
+        self._frame_count = 0
+
+    def get_scored_faces(
+            self,
+            image: Union[np.ndarray, str]) -> Tuple[
+                List[List[int]], List[float]]:
+        """Return fused faces for an image and their scores.
+
+        Raises:
+            FileNotFoundError: if image is a path that cannot be read.
+        """
+        if (isinstance(image, str)):
+            read_image = cv.imread(image)
+            if (read_image is None):
+                raise FileNotFoundError(f'Could not read image {image}')
+            image = read_image
+        frame: np.ndarray = image
+        full_frame = (self.full_frame_interval > 0
+                      and self._frame_count % self.full_frame_interval == 0)
+        self._frame_count += 1
+        if (full_frame):
+            faces, scores = _get_scored_faces(self.detector, frame)
+            return self._filter(faces, scores)
+        all_faces: List[np.ndarray] = [np.zeros((0, 4))]
+        all_scores: List[np.ndarray] = [np.zeros(0)]
+        candidates, candidate_scores = _get_scored_faces(
+            self.candidate_detector, frame)
+        # overlapping candidates would run the detector on the same face
+        regions = candidates[non_max_suppression(
+            candidates, candidate_scores, self.iou_threshold)]
+        for region in regions:
+            x_start, y_start, x_end, y_end = self._region_cropper.get_box(
+                region, frame.shape)
+            if (x_start >= x_end or y_start >= y_end):
+                continue
+            faces, scores = _get_scored_faces(
+                self.detector, frame[y_start:y_end, x_start:x_end])
+            faces[:, 0] += x_start
+            faces[:, 1] += y_start
+            all_faces.append(faces)
+            all_scores.append(scores)
+        return self._filter(
+            np.concatenate(all_faces), np.concatenate(all_scores))
+
+
+def create_filtered_detector(
+        detector_factory: Callable[[], IFaceDetector],
+        iou_threshold: float = 0.3,
+        top_k: int = 0,
+        min_size: int = 0,
+        candidate_factory: Optional[Callable[[], IFaceDetector]] = None,
+        full_frame_interval: int = 30) -> FilteredFaceDetector:
+    """Create a filtered detector from picklable detector factories.
+
+    Used with functools.partial to build detectors in batch workers.
+
+    Args:
+        detector_factory: creates the detector to filter.
+        iou_threshold: non-maximum suppression threshold.
+        top_k: maximum number of faces per image (0 = no limit).
+        min_size: minimum width and height of a face in pixels.
+        candidate_factory: creates a cheap candidate detector to fuse with
+            the detector. Defaults to None (no fusion).
+        full_frame_interval: frames between full-frame runs of the
+            detector when fusing.
+
+    Returns:
+        the filtered detector.
+    """
+    if (candidate_factory is None):
+        return FilteredFaceDetector(
+            detector_factory(), iou_threshold, top_k, min_size)
+    return CascadeFusionDetector(
+        candidate_factory(), detector_factory(),
+        full_frame_interval=full_frame_interval,
+        iou_threshold=iou_threshold, top_k=top_k, min_size=min_size)
@@ -0,0 +1,132 @@
+"""Module to cut detected faces out of frames and encode them."""
+import numpy as np
+import cv2 as cv
+from typing import Optional, Sequence, Tuple, Union
+
+
+class FaceCropper:
+    """Cuts faces out of frames without copying pixel data where possible."""
+
+    def __init__(
+            self,
+            margin: float = 0.0,
+            pad: bool = False,
+            image_format: str = '.png') -> None:
+        """Initialize the cropper.
+
+        Args:
+            margin: fraction of the face width and height added on each
+                side of the box. Defaults to 0.0.
+            pad: if True, parts of the expanded box that fall outside the
+                frame are filled with black so every crop has the requested
+                size. If False, boxes are clamped to the frame.
+                Defaults to False.
+            image_format: extension of the format crops are encoded to.
+                Defaults to .png.
+        """
+        self.margin = margin
+        self.pad = pad
+        self.image_format = image_format
+        self._pad_buffer = np.zeros(0, dtype=np.uint8)
+
+    def get_box(
+            self,
+            face: Sequence[Union[int, float]],
+            image_shape: Tuple[int, ...]) -> Tuple[int, int, int, int]:
+        """Expand a face by the margin and convert it to int pixel bounds.
+
+        Args:
+            face: face coordinates (x, y, w, h), ints or floats.
+            image_shape: shape of the frame the face was found in.
+
+        Returns:
+            (x_start, y_start, x_end, y_end) of the box. Clamped to the frame
+            unless pad is set.
+        """
+        x, y, w, h = (float(value) for value in face[:4])
+        x_start = int(round(x - w * self.margin))
+        y_start = int(round(y - h * self.margin))
+        x_end = int(round(x + w * (1 + self.margin)))
+        y_end = int(round(y + h * (1 + self.margin)))
+        if (not self.pad):
+            height, width = image_shape[:2]
+            x_start, x_end = max(x_start, 0), min(x_end, width)
+            y_start, y_end = max(y_start, 0), min(y_end, height)
+        return x_start, y_start, x_end, y_end
+
+    def crop(
+            self,
+            image: np.ndarray,
+            face: Sequence[Union[int, float]]) -> Optional[np.ndarray]:
+        """Cut a face out of a frame.
+
+        The crop is a view into the frame, or into a buffer reused between
+        calls when padding is needed, so it is only valid until the next
+        call to crop.
+
+        Args:
+            image: frame the face was found in.
+            face: face coordinates (x, y, w, h).
+
+        Returns:
+            the cut image, or None if the box does not overlap the frame.
+        """
+        x_start, y_start, x_end, y_end = self.get_box(face, image.shape)
+        height, width = image.shape[:2]
+        inner_x_start, inner_x_end = max(x_start, 0), min(x_end, width)
+        inner_y_start, inner_y_end = max(y_start, 0), min(y_end, height)
+        if (inner_x_start >= inner_x_end or inner_y_start >= inner_y_end):
+            return None
+        inner = image[inner_y_start:inner_y_end, inner_x_start:inner_x_end]
+        if (inner_x_start == x_start and inner_x_end == x_end
+                and inner_y_start == y_start and inner_y_end == y_end):
+            return inner
+        padded = self._get_pad_buffer(
+            (y_end - y_start, x_end - x_start) + image.shape[2:],
+            image.dtype)
+        padded[...] = 0
+        padded[inner_y_start - y_start:inner_y_end - y_start,
+               inner_x_start - x_start:inner_x_end - x_start] = inner
+        return padded
+
+    def encode(
+            self,
+            cut_image: np.ndarray,
+            scale: float = 1.0) -> memoryview:
+        """Encode a cut image and return a view of the encoded bytes.
+
+        Args:
+            cut_image: image returned by crop.
+            scale: factor the image is resized by before encoding, used to
+                trade quality for size. Defaults to 1.0.
+
+        Returns:
+            memoryview over the encoded image.
+
+        Raises:
+            ValueError: if OpenCV fails to encode the image.
+        """
+        if (scale < 1.0):
+            # compute the size here, cv.resize fails if a side rounds to 0
+            height, width = cut_image.shape[:2]
+            cut_image = cv.resize(
+                cut_image,
+                (max(1, round(width * scale)), max(1, round(height * scale))),
+                interpolation=cv.INTER_AREA)
+        encoded: bool
+        buffer: np.ndarray
+        encoded, buffer = cv.imencode(self.image_format, cut_image)
+        if (not encoded):
+            raise ValueError(
+                f'Could not encode image of shape {cut_image.shape} '
+                f'as {self.image_format}.')
+        return buffer.data
+
+    def _get_pad_buffer(
+            self,
+            shape: Tuple[int, ...],
+            dtype: np.dtype) -> np.ndarray:
+        size = int(np.prod(shape))
+        if (self._pad_buffer.dtype != dtype or self._pad_buffer.size < size):
+            self._pad_buffer = np.empty(size, dtype=dtype)
+        return self._pad_buffer[:size].reshape(shape)
@@ -1,7 +1,7 @@
 """Classes to aid in detecting faces."""
 import numpy as np
 import cv2 as cv
-from typing import List, Union
+from typing import List, Tuple, Union
 import pathlib
 import os
 import errno
@@ -17,6 +17,18 @@ class IFaceDetector(ABC):
         raise NotImplementedError
 
 
+class IScoredFaceDetector(IFaceDetector):
+    """Interface for face detectors that report a confidence per face."""
+
+    @abstractmethod
+    def get_scored_faces(
+            self,
+            image: Union[np.ndarray, str]) -> Tuple[
+                List[List[int]], List[float]]:
+        """Return faces for an image and the confidence of each face."""
+        raise NotImplementedError
+
+
 class FaceDetector(IFaceDetector):
     """Detects faces in images."""
 
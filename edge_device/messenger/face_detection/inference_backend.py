@@ -0,0 +1,304 @@
+"""Inference backends used by the neural face detector.
+
+Every backend runs an SSD-style face detection model and returns boxes in
+the same format, so NeuralFaceDetector can switch runtimes without changing
+its output. Runtime imports are done when a backend is created so edge
+devices only need the runtime they actually use installed.
+"""
+import numpy as np
+import cv2 as cv
+from abc import ABC, abstractmethod
+from typing import Any, List, Optional, Tuple
+
+_TF_INPUT_TENSOR = 'image_tensor:0'
+_TF_OUTPUT_NODES = [
+    'detection_scores',
+    'detection_boxes',
+    'detection_classes',
+    'num_detections']
+
+
+class IInferenceBackend(ABC):
+    """Interface for running a face detection model."""
+
+    @abstractmethod
+    def detect(self, image: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Run the model on an image already resized to the input size.
+
+        Args:
+            image: uint8 image of shape (height, width, 3).
+
+        Returns:
+            tuple of (boxes, scores). boxes has shape (N, 4) and holds
+            normalized [ymin, xmin, ymax, xmax] coordinates, scores has
+            shape (N,).
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def close(self) -> None:
+        """Release resources held by the backend."""
+        raise NotImplementedError
+
+
+class TensorflowBackend(IInferenceBackend):
+    """Runs a frozen Tensorflow 1 graph in a tf.compat.v1.Session."""
+
+    def __init__(
+            self,
+            graph_path: str,
+            optimize_graph: bool = False,
+            intra_op_threads: int = 0,
+            inter_op_threads: int = 0) -> None:
+        """Load the frozen graph into a new session.
+
+        Args:
+            graph_path: path to the frozen inference graph.
+            optimize_graph: strip nodes that are not needed to compute the
+                detections and enable constant folding. Defaults to False.
+            intra_op_threads: threads used inside a single op.
+                Defaults to 0 (let Tensorflow pick).
+            inter_op_threads: threads used to run independent ops.
+                Defaults to 0 (let Tensorflow pick).
+        """
+        import tensorflow as tf
+        from tensorflow.core.protobuf import rewriter_config_pb2
+        self.tf_graph = tf.compat.v1.GraphDef()
+        with open(graph_path, 'rb') as graph:
+            self.tf_graph.ParseFromString(graph.read())
+        self.tf_config = tf.compat.v1.ConfigProto()
+        self.tf_config.gpu_options.allow_growth = True
+        self.tf_config.intra_op_parallelism_threads = intra_op_threads
+        self.tf_config.inter_op_parallelism_threads = inter_op_threads
+        if (optimize_graph):
+            self.tf_graph = tf.compat.v1.graph_util.extract_sub_graph(
+                self.tf_graph, _TF_OUTPUT_NODES)
+            graph_options = self.tf_config.graph_options
+            graph_options.rewrite_options.constant_folding = (
+                rewriter_config_pb2.RewriterConfig.ON)
+            graph_options.optimizer_options.do_constant_folding = True
+        tf_graph = tf.Graph()
+        with tf_graph.as_default():
+            tf.import_graph_def(self.tf_graph, name='')
+        self.tf_session = tf.compat.v1.Session(
+            graph=tf_graph, config=self.tf_config)
+        self.tf_input = tf_graph.get_tensor_by_name(_TF_INPUT_TENSOR)
+        self.tf_outputs = [
+            tf_graph.get_tensor_by_name(f'{name}:0')
+            for name in _TF_OUTPUT_NODES[:2]]
+
+    def detect(self, image: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Run the graph and return boxes and scores."""
+        scores, boxes = self.tf_session.run(
+            self.tf_outputs, feed_dict={self.tf_input: image[None, ...]})
+        # index by 0 to remove batch dimension
+        return boxes[0], scores[0]
+
+    def close(self) -> None:
+        """Close the Tensorflow session."""
+        self.tf_session.close()
+
+
+class TFLiteBackend(IInferenceBackend):
+    """Runs a TFLite SSD model with the detection post-processing op.
+
+    Works with float and quantized (uint8/int8) models. The quantization
+    parameters of an integer input already map raw pixels to the model
+    input, so uint8 inputs get the pixels as they are and int8 inputs get
+    pixel - 128. Quantized outputs are converted with their quantization
+    parameters, so boxes come back in the same normalized format as the
+    float model.
+    """
+
+    def __init__(
+            self,
+            model_path: str,
+            num_threads: Optional[int] = None,
+            input_mean: float = 127.5,
+            input_std: float = 127.5,
+            output_indices: Tuple[int, int] = (0, 2)) -> None:
+        """Load the model into a TFLite interpreter.
+
+        Args:
+            model_path: path to the .tflite model.
+            num_threads: threads used by the interpreter.
+                Defaults to None (let TFLite pick).
+            input_mean: mean subtracted from pixels for float inputs.
+                Defaults to 127.5.
+            input_std: value pixels are divided by for float inputs.
+                Defaults to 127.5.
+            output_indices: positions of the boxes and scores tensors in
+                the model outputs. Defaults to (0, 2), the order produced by
+                TFLite_Detection_PostProcess.
+        """
+        interpreter_class: Any
+        try:
+            from tflite_runtime.interpreter import Interpreter
+            interpreter_class = Interpreter
+        except ImportError:
+            import tensorflow as tf
+            interpreter_class = tf.lite.Interpreter
+        self._interpreter = interpreter_class(
+            model_path=model_path, num_threads=num_threads)
+        self._interpreter.allocate_tensors()
+        self._input_details = self._interpreter.get_input_details()[0]
+        output_details = self._interpreter.get_output_details()
+        self._boxes_details = output_details[output_indices[0]]
+        self._scores_details = output_details[output_indices[1]]
+        self._input_mean = input_mean
+        self._input_std = input_std
+
+    def detect(self, image: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Run the interpreter and return boxes and scores."""
+        self._interpreter.set_tensor(
+            self._input_details['index'], self._prepare_input(image))
+        self._interpreter.invoke()
+        boxes = self._read_output(self._boxes_details)
+        scores = self._read_output(self._scores_details)
+        # index by 0 to remove batch dimension
+        return boxes[0], scores[0]
+
+    def close(self) -> None:
+        """Release the interpreter."""
+        del self._interpreter
+
+    def _prepare_input(self, image: np.ndarray) -> np.ndarray:
+        input_type = self._input_details['dtype']
+        if (input_type == np.uint8):
+            return image[None, ...]
+        if (input_type == np.int8):
+            shifted: np.ndarray = (
+                image.astype(np.int16) - 128).astype(np.int8)
+            return shifted[None, ...]
+        float_image = (image.astype(np.float32) - self._input_mean) / \
+            self._input_std
+        return float_image.astype(input_type)[None, ...]
+
+    def _read_output(self, details: Any) -> np.ndarray:
+        output: np.ndarray = self._interpreter.get_tensor(details['index'])
+        scale, zero_point = details['quantization']
+        if (scale != 0):
+            output = (output.astype(np.float32) - zero_point) * scale
+        return output
+
+
+class OpenCVDnnBackend(IInferenceBackend):
+    """Runs an SSD model with the OpenCV dnn module.
+
+    Accepts any model cv.dnn.readNet understands whose output is the
+    standard DetectionOutput layout (1, 1, N, 7), e.g. the Tensorflow face
+    graph with a config generated by tf_text_graph_ssd.py or the res10
+    Caffe face detector. res10 expects BGR images with
+    mean=(104, 177, 123) subtracted. OpenCV before 3.4 has no readNet, so
+    only Caffe (.caffemodel) and Tensorflow (.pb) models are supported
+    there.
+    """
+
+    def __init__(
+            self,
+            model_path: str,
+            config_path: str = '',
+            num_threads: int = 0,
+            scale_factor: float = 1.0,
+            mean: Tuple[float, float, float] = (0.0, 0.0, 0.0)) -> None:
+        """Load the network.
+
+        Args:
+            model_path: path to the model weights.
+            config_path: path to the network description, if the model
+                format needs one. Defaults to ''.
+            num_threads: threads used by OpenCV.
+                Defaults to 0 (leave the OpenCV setting unchanged).
+            scale_factor: multiplier applied to pixels. Defaults to 1.0.
+            mean: per-channel mean subtracted from pixels.
+                Defaults to (0, 0, 0).
+        """
+        if (num_threads > 0):
+            cv.setNumThreads(num_threads)
+        self._net = _read_net(model_path, config_path)
+        # DNN_BACKEND_OPENCV was called DNN_BACKEND_DEFAULT before 3.4
+        self._net.setPreferableBackend(getattr(
+            cv.dnn, 'DNN_BACKEND_OPENCV', cv.dnn.DNN_BACKEND_DEFAULT))
+        self._net.setPreferableTarget(cv.dnn.DNN_TARGET_CPU)
+        self._scale_factor = scale_factor
+        self._mean = mean
+
+    def detect(self, image: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Run the network and return boxes and scores."""
+        blob = cv.dnn.blobFromImage(
+            image, self._scale_factor, (image.shape[1], image.shape[0]),
+            self._mean, swapRB=False, crop=False)
+        self._net.setInput(blob)
+        # rows are [image_id, class_id, score, xmin, ymin, xmax, ymax]
+        detections: np.ndarray = self._net.forward().reshape(-1, 7)
+        boxes: np.ndarray = detections[:, [4, 3, 6, 5]]
+        scores: np.ndarray = detections[:, 2]
+        return boxes, scores
+
+    def close(self) -> None:
+        """Release the network."""
+        del self._net
+
+
+def _read_net(model_path: str, config_path: str) -> Any:
+    """Load a network, also on OpenCV versions without cv.dnn.readNet."""
+    if (hasattr(cv.dnn, 'readNet')):
+        return cv.dnn.readNet(model_path, config_path)
+    if (model_path.endswith('.caffemodel')):
+        # looked up by name, newer OpenCV versions removed the Caffe loader
+        return getattr(cv.dnn, 'readNetFromCaffe')(config_path, model_path)
+    if (model_path.endswith('.pb')):
+        if (config_path == ''):
+            return cv.dnn.readNetFromTensorflow(model_path)
+        return cv.dnn.readNetFromTensorflow(model_path, config_path)
+    raise ValueError(
+        f'OpenCV {cv.__version__} can only load Caffe (.caffemodel) and '
+        f'Tensorflow (.pb) models, got {model_path}.')
+
+
+BACKENDS: List[str] = ['tensorflow', 'tflite', 'opencv']
+
+
+def create_backend(
+        backend: str,
+        model_path: str,
+        config_path: str = '',
+        optimize_graph: bool = False,
+        intra_op_threads: int = 0,
+        inter_op_threads: int = 0,
+        dnn_scale_factor: float = 1.0,
+        dnn_mean: Tuple[float, float, float] = (0.0, 0.0, 0.0)
+) -> IInferenceBackend:
+    """Create an inference backend by name.
+
+    Args:
+        backend: one of BACKENDS.
+        model_path: path to the model for the backend.
+        config_path: network description for the opencv backend.
+            Defaults to ''.
+        optimize_graph: strip and fold the graph for the tensorflow
+            backend. Defaults to False.
+        intra_op_threads: threads used inside a single op. Used as the
+            thread count for tflite and opencv. Defaults to 0 (runtime
+            default).
+        inter_op_threads: threads used to run independent ops with the
+            tensorflow backend. Defaults to 0 (runtime default).
+        dnn_scale_factor: multiplier applied to pixels by the opencv
+            backend. Defaults to 1.0.
+        dnn_mean: per-channel mean subtracted from pixels by the opencv
+            backend. Defaults to (0, 0, 0).
+
+    Returns:
+        the created backend.
+    """
+    if (backend == 'tensorflow'):
+        return TensorflowBackend(
+            model_path, optimize_graph, intra_op_threads, inter_op_threads)
+    if (backend == 'tflite'):
+        return TFLiteBackend(model_path, intra_op_threads or None)
+    if (backend == 'opencv'):
+        return OpenCVDnnBackend(
+            model_path, config_path, intra_op_threads, dnn_scale_factor,
+            dnn_mean)
+    raise ValueError(
+        f'Unknown backend {backend}, expected one of {BACKENDS}.')
@@ -1,11 +1,14 @@
 """Module to publish detected faces to the message broker."""
+import threading
+import time
 import paho.mqtt.client as mqtt
 from .face_detector import IFaceDetector
 from .video_streamer import IVideoStreamer
+from .face_cropper import FaceCropper
+from .publish_controller import AdaptiveQosController
 from abc import ABC, abstractmethod
 import numpy as np
-from typing import List
-import cv2 as cv
+from typing import Any, Dict, List, Optional, Set, Tuple, Union
 
 
 class IMessagingClient(ABC):
@@ -31,28 +34,60 @@ class IMessagingClient(ABC):
         """Stop loop previously started with loop_start."""
         raise NotImplementedError
 
+    @abstractmethod
+    def is_connected(self) -> bool:
+        """Return whether the client is connected to the message broker."""
+        raise NotImplementedError
+
     @abstractmethod
     def publish(
             self,
             output_channel: str,
-            message: str,
-            guarantee_level: int) -> None:
+            message: Union[bytes, memoryview],
+            guarantee_level: int) -> bool:
         """Publish message to broker.
 
         Args:
             output_channel: channel on which to publish message.
             message: message to publish.
             guarantee_level: level of guarantee that message is delivered.
+
+        Returns:
+            whether the client accepted the message for delivery.
         """
         raise NotImplementedError
 
+    @abstractmethod
+    def pending_count(self) -> int:
+        """Return number of messages waiting to be sent or acknowledged."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def ack_latency(self) -> float:
+        """Return recent time in seconds for a message to be acknowledged."""
+        raise NotImplementedError
+
 
 class MqttClient(IMessagingClient):
     """Mqtt implementation of IMessagingClient."""
 
-    def __init__(self) -> None:
-        """Initialize mqtt.Client."""
+    def __init__(self, latency_smoothing: float = 0.2) -> None:
+        """Initialize mqtt.Client.
+
+        Args:
+            latency_smoothing: weight of the newest acknowledgement in the
+                moving average of acknowledgement latency. Defaults to 0.2.
+        """
         self._client = mqtt.Client()
+        self._client.on_publish = self._on_publish
+        self._client.on_connect = self._on_connect
+        self._client.on_disconnect = self._on_disconnect
+        self._latency_smoothing = latency_smoothing
+        self._pending_lock = threading.Lock()
+        # mid -> (time published, quality of service)
+        self._pending: Dict[int, Tuple[float, int]] = {}
+        self._acked_before_tracked: Set[int] = set()
+        self._ack_latency = 0.0
 
     def connect_async(self, hostname: str, port: int) -> None:
         """Connect asyncronously to Mqtt broker."""
@@ -70,11 +105,15 @@ class MqttClient(IMessagingClient):
         """Stop loop previously started with loop_start."""
         self._client.loop_stop()
 
+    def is_connected(self) -> bool:
+        """Return whether the client is connected to the message broker."""
+        return bool(self._client.is_connected())
+
     def publish(
             self,
             output_channel: str,
-            message: str,
-            guarantee_level: int) -> None:
+            message: Union[bytes, memoryview],
+            guarantee_level: int) -> bool:
         """Publish message to broker.
 
         Args:
@@ -83,8 +122,82 @@ class MqttClient(IMessagingClient):
             guarantee_level: mqtt quality of service to use when publishing
                 message.
                 0 = at most once, 1 = at least once, 2 = exactly once.
+
+        Returns:
+            whether the message was sent or queued for delivery. QoS 0
+            messages are dropped while the client is not connected.
         """
-        self._client.publish(output_channel, message, guarantee_level)
+        # paho only accepts bytes/bytearray payloads and keeps QoS 1/2
+        # payloads until they are acknowledged, so it needs its own copy.
+        payload = message if isinstance(message, bytes) else bytes(message)
+        published_at = time.monotonic()
+        info = self._client.publish(output_channel, payload, guarantee_level)
+        queued_for_retry = (guarantee_level > 0
+                            and info.rc == mqtt.MQTT_ERR_NO_CONN)
+        if (info.rc != mqtt.MQTT_ERR_SUCCESS and not queued_for_retry):
+            print(f'Message dropped by client: {mqtt.error_string(info.rc)}')
+            return False
+        with self._pending_lock:
+            # on_publish runs on the network thread and can fire before
+            # publish returns the mid
+            if (info.mid in self._acked_before_tracked):
+                self._acked_before_tracked.remove(info.mid)
+            else:
+                self._pending[info.mid] = (published_at, guarantee_level)
+        return True
+
+    def pending_count(self) -> int:
+        """Return number of messages waiting to be sent or acknowledged."""
+        with self._pending_lock:
+            return len(self._pending)
+
+    def ack_latency(self) -> float:
+        """Return recent time in seconds for a message to be acknowledged.
+
+        This is the moving average of acknowledgement latency, or the age
+        of the oldest unacknowledged message if that is larger, so a
+        stalled link is noticed before any acknowledgement arrives.
+        """
+        with self._pending_lock:
+            oldest_age = 0.0
+            if (len(self._pending) > 0):
+                oldest_age = time.monotonic() - min(
+                    published_at for published_at, _ in self._pending.values())
+            return max(self._ack_latency, oldest_age)
+
+    def _on_publish(self, _: mqtt.Client, __: Any, mid: int) -> None:
+        acked_at = time.monotonic()
+        with self._pending_lock:
+            pending = self._pending.pop(mid, None)
+            if (pending is None):
+                self._acked_before_tracked.add(mid)
+                return
+            self._ack_latency += self._latency_smoothing * (
+                acked_at - pending[0] - self._ack_latency)
+
+    def _on_connect(
+            self,
+            _: mqtt.Client,
+            __: Any,
+            ___: Dict[str, int],
+            ____: int) -> None:
+        self._forget_qos0()
+
+    def _on_disconnect(
+            self,
+            _: mqtt.Client,
+            __: Any,
+            ___: int) -> None:
+        self._forget_qos0()
+
+    def _forget_qos0(self) -> None:
+        # paho discards queued QoS 0 packets when it reconnects without
+        # calling on_publish, so they would otherwise stay pending forever.
+        # QoS 1/2 messages are kept and resent by paho.
+        with self._pending_lock:
+            self._pending = {
+                mid: pending for mid, pending in self._pending.items()
+                if pending[1] > 0}
 
 
 class FaceMessenger:
@@ -97,7 +210,10 @@ class FaceMessenger:
             broker_port: int,
             video_streamer: IVideoStreamer,
             messaging_client: IMessagingClient = MqttClient(),
-            guarantee_level: int = 0) -> None:
+            guarantee_level: int = 0,
+            crop_margin: float = 0.0,
+            pad_crops: bool = False,
+            qos_controller: Optional[AdaptiveQosController] = None) -> None:
         """Initialize the client.
 
         Args:
@@ -109,6 +225,13 @@ class FaceMessenger:
             video_streamer: streamer used to stream video.
             guarantee_level: level of guarantee for message delivery.
                 Defaults to 0 (at most once)
+            crop_margin: fraction of the face width and height added on
+                each side of a face before it is cut out. Defaults to 0.0.
+            pad_crops: pad faces that extend past the frame edge instead
+                of clamping them. Defaults to False.
+            qos_controller: controller used to degrade publishing while the
+                broker link is congested. Defaults to None (always publish
+                every face at guarantee_level).
         """
         self._client = messaging_client
         self.output_channel = output_channel
@@ -116,23 +239,70 @@ class FaceMessenger:
         self.broker_port = broker_port
         self.video_streamer = video_streamer
         self.guarantee_level = guarantee_level
+        self._cropper = FaceCropper(crop_margin, pad_crops)
+        self._qos_controller = qos_controller
 
     def _process_faces(self, image: np.ndarray,
                        faces: List[List[int]]) -> None:
         """Cut faces from image and send to broker."""
-        for (x, y, w, h) in faces:
-            cut_image = image[y:y + h, x:x + w]
-            _, png = cv.imencode('.png', cut_image)
-            png_bytes = png.tobytes()
+        if (len(faces) == 0):
+            return
+        scale = 1.0
+        if (self._qos_controller is not None):
+            level = self._qos_controller.update(
+                self._client.pending_count(), self._client.ack_latency())
+            if (not self._qos_controller.should_publish()):
+                return
+            scale = level.scale
+        for face in faces:
+            cut_image = self._cropper.crop(image, face)
+            if (cut_image is None):
+                continue
+            guarantee_level = self.guarantee_level
+            if (self._qos_controller is not None):
+                guarantee_level = self._qos_controller.get_guarantee_level(
+                    face, image.shape, guarantee_level)
             self._client.publish(
                 self.output_channel,
-                png_bytes,
-                self.guarantee_level)
+                self._cropper.encode(cut_image, scale),
+                guarantee_level)
 
-    def stream_messages(self) -> None:
-        """Start streaming messages."""
+    def stream_messages(self, drain_timeout: float = 8.0) -> None:
+        """Start streaming messages.
+
+        Returns once the stream ends or stop is called, after waiting up to
+        drain_timeout seconds for queued messages to be delivered.
+        """
         self._client.connect_async(self.broker_host, self.broker_port)
         self._client.loop_start()
         self.video_streamer.start_stream(self._process_faces)
+        self.drain(drain_timeout)
         self._client.loop_stop()
         self._client.disconnect()
+
+    def stop(self) -> None:
+        """Stop capturing so stream_messages drains and returns.
+
+        Safe to call from a signal handler.
+        """
+        self.video_streamer.stop_stream()
+
+    def drain(self, timeout: float) -> Tuple[int, int]:
+        """Wait for queued messages to be sent and acknowledged.
+
+        Args:
+            timeout: maximum seconds to wait.
+
+        Returns:
+            tuple of (flushed, abandoned) message counts.
+        """
+        pending = self._client.pending_count()
+        deadline = time.monotonic() + timeout
+        while (self._client.pending_count() > 0
+               and time.monotonic() < deadline):
+            time.sleep(0.05)
+        abandoned = self._client.pending_count()
+        flushed = max(pending - abandoned, 0)
+        print(f'Publish queue drained: {flushed} messages flushed, '
+              f'{abandoned} abandoned.')
+        return flushed, abandoned
@@ -1,42 +1,75 @@
 """Classes for neural face detector implementation."""
+import time
 import numpy as np
-import tensorflow as tf
 from PIL import Image
-from typing import Tuple, Union, List, Dict
-from .face_detector import IFaceDetector
+from typing import Tuple, Union, List, Optional
+from .face_detector import IScoredFaceDetector
+from .inference_backend import IInferenceBackend, create_backend
 
 
-class NeuralFaceDetector(IFaceDetector):
+class NeuralFaceDetector(IScoredFaceDetector):
     """Uses a pretrained neural network to detect faces."""
 
     def __init__(
             self, graph_path: str, input_size: Tuple[int, int],
-            detection_threshold: float = 0.5) -> None:
-        """Initialize the classifier."""
+            detection_threshold: float = 0.5,
+            optimize_graph: bool = False,
+            warmup_runs: int = 0,
+            intra_op_threads: int = 0,
+            inter_op_threads: int = 0,
+            backend: Union[str, IInferenceBackend] = 'tensorflow',
+            config_path: str = '',
+            dnn_scale_factor: float = 1.0,
+            dnn_mean: Tuple[float, float, float] = (0.0, 0.0, 0.0)) -> None:
+        """Initialize the classifier.
+
+        Args:
+            graph_path: path to the model loaded by the backend
+                (frozen graph for tensorflow, .tflite model for tflite,
+                weights for opencv).
+            input_size: (width, height) images are resized to before
+                inference.
+            detection_threshold: minimum score for a detection to be
+                returned as a face. Defaults to 0.5.
+            optimize_graph: strip nodes that are not needed to compute the
+                detections and enable constant folding (tensorflow backend
+                only). Defaults to False.
+            warmup_runs: number of inferences to run on a blank image at
+                load time so the first real frame does not pay for graph
+                optimization and memory allocation. Defaults to 0.
+            intra_op_threads: threads used inside a single op, also used
+                as the thread count for tflite and opencv.
+                Defaults to 0 (let the runtime pick).
+            inter_op_threads: threads used to run independent ops
+                (tensorflow backend only). Defaults to 0 (let Tensorflow
+                pick).
+            backend: name of the inference backend (tensorflow, tflite or
+                opencv) or an already created backend.
+                Defaults to tensorflow.
+            config_path: network description for the opencv backend.
+                Defaults to ''.
+            dnn_scale_factor: multiplier applied to pixels by the opencv
+                backend. Defaults to 1.0.
+            dnn_mean: per-channel mean subtracted from pixels by the opencv
+                backend, e.g. (104, 177, 123) for the res10 Caffe model.
+                Defaults to (0, 0, 0).
+        """
         self.input_x = input_size[0]
         self.input_y = input_size[1]
-        self.tf_graph = tf.compat.v1.GraphDef()
-        with open(graph_path, 'rb') as graph:
-            self.tf_graph.ParseFromString(graph.read())
-        self.tf_config = tf.compat.v1.ConfigProto()
-        self.tf_config.gpu_options.allow_growth = True
-        self.tf_session = tf.compat.v1.Session(config=self.tf_config)
-        tf.import_graph_def(self.tf_graph, name='')
-        self.tf_input: tf.Tensor = self.tf_session.graph.get_tensor_by_name(
-            'image_tensor:0')
-        self.tf_scores = self.tf_session.graph.get_tensor_by_name(
-            'detection_scores:0')
-        self.tf_boxes = self.tf_session.graph.get_tensor_by_name(
-            'detection_boxes:0')
-        self.tf_classes = self.tf_session.graph.get_tensor_by_name(
-            'detection_classes:0')
-        self.tf_num_detections = self.tf_session.graph.get_tensor_by_name(
-            'num_detections:0')
+        if (isinstance(backend, str)):
+            backend = create_backend(
+                backend, graph_path, config_path, optimize_graph,
+                intra_op_threads, inter_op_threads, dnn_scale_factor,
+                dnn_mean)
+        self.backend = backend
         self.detection_threshold = detection_threshold
+        self.warmup_latency: Optional[float] = None
+        if (warmup_runs > 0):
+            self.warmup_latency = self.warm_up(warmup_runs)
 
     def __del__(self) -> None:
-        """Release Tensorflow resources."""
-        self.tf_session.close()
+        """Release inference backend resources."""
+        self.backend.close()
 
     def get_faces(self, image: Union[np.ndarray, str]) -> List[List[int]]:
         """
@@ -49,13 +82,31 @@ class NeuralFaceDetector(IFaceDetector):
         Returns:
             array of tuples for coordinates of faces (x, y, w, h)
         """
+        faces, _ = self.get_scored_faces(image)
+        return faces
+
+    def get_scored_faces(
+            self,
+            image: Union[np.ndarray, str]) -> Tuple[
+                List[List[int]], List[float]]:
+        """
+        Return faces for an image and the score of each face.
+
+        Args:
+            image: image to classify.
+                Either an image as an ndarray or path to an image on disk.
+
+        Returns:
+            tuple of (faces, scores). faces holds coordinates of faces
+            (x, y, w, h), scores the network score of each face.
+        """
         pillow_image: Image
         if(isinstance(image, str)):
             pillow_image = Image.open(image)
         else:
             pillow_image = Image.fromarray(image)
         processed_image = self._preprocess_image(pillow_image)
-        boxes = self._get_faces_from_network(processed_image)
+        boxes, scores = self._get_faces_from_network(processed_image)
         np_image: np.ndarray = np.array(pillow_image)
         scaler = np.array(
             [np_image.shape[0],
@@ -63,21 +114,41 @@ class NeuralFaceDetector(IFaceDetector):
              np_image.shape[0],
              np_image.shape[1]])
         scaled_boxes: List[List[int]] = [box * scaler for box in boxes]
-        return [[box[1], box[0], box[3] - box[1], box[2] - box[0]]
-                for box in scaled_boxes]
-
-    def _get_faces_from_network(self, image: np.ndarray) -> List[np.ndarray]:
-        feed_dict: Dict[tf.Tensor, np.ndarray] = {
-            self.tf_input: image[None, ...]
-        }
-        scores, boxes_batch, classes, num_detections = self.tf_session.run(
-            [self.tf_scores, self.tf_boxes, self.tf_classes, self.
-             tf_num_detections],
-            feed_dict=feed_dict)
-        # index by 0 to remove batch dimension
-        boxes: List[np.ndarray] = [box for box, score in zip(
-            boxes_batch[0], scores[0]) if score >= self.detection_threshold]
-        return boxes
+        faces = [[box[1], box[0], box[3] - box[1], box[2] - box[0]]
+                 for box in scaled_boxes]
+        return faces, [float(score) for score in scores]
+
+    def warm_up(self, runs: int) -> float:
+        """Run inference on a blank image at the configured input size.
+
+        The first run pays for graph optimization and memory allocation, so
+        it is excluded from the reported latency when runs > 1.
+
+        Args:
+            runs: number of inferences to run.
+
+        Returns:
+            median steady-state latency of a single inference in seconds.
+        """
+        blank_image = np.zeros(
+            (self.input_y, self.input_x, 3), dtype=np.uint8)
+        latencies: List[float] = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            self._get_faces_from_network(blank_image)
+            latencies.append(time.perf_counter() - start)
+        steady_latencies = latencies[1:] if len(latencies) > 1 else latencies
+        latency = float(np.median(steady_latencies))
+        print(f'Warm-up complete after {runs} runs. '
+              f'First run: {latencies[0] * 1000:.1f} ms, '
+              f'steady-state: {latency * 1000:.1f} ms.')
+        return latency
+
+    def _get_faces_from_network(
+            self, image: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        boxes, scores = self.backend.detect(image)
+        detected = scores >= self.detection_threshold
+        return boxes[detected], scores[detected]
 
     def _preprocess_image(self, pillow_image: Image) -> np.ndarray:
         resized_image = np.array(
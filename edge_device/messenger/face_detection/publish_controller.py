@@ -0,0 +1,151 @@
+"""Module to adapt publishing to backpressure from the message broker."""
+import time
+from typing import Callable, List, NamedTuple, Sequence, Tuple, Union
+
+
+class DegradationLevel(NamedTuple):
+    """How much publishing is degraded at one congestion level.
+
+    Attributes:
+        min_interval: minimum seconds between published frames.
+        scale: factor crops are resized by before encoding.
+        downgrade_low_priority: publish low-priority faces with QoS 0.
+    """
+
+    min_interval: float
+    scale: float
+    downgrade_low_priority: bool
+
+
+DEFAULT_LEVELS: List[DegradationLevel] = [
+    DegradationLevel(0.0, 1.0, False),
+    DegradationLevel(0.0, 1.0, True),
+    DegradationLevel(0.2, 0.75, True),
+    DegradationLevel(0.5, 0.5, True)]
+
+
+class AdaptiveQosController:
+    """Degrades publishing while the broker link is congested.
+
+    The link is congested when too many messages are waiting to be sent or
+    acknowledged, or when acknowledgements are slow. Each congested update
+    moves one level down the degradation ladder and each clear update moves
+    one level back up, at most once per hold_time so the level does not
+    flap. Frames are dropped outright while max_pending messages are
+    waiting, which bounds memory on the device.
+    """
+
+    def __init__(
+            self,
+            high_watermark: int = 20,
+            low_watermark: int = 5,
+            max_pending: int = 100,
+            latency_limit: float = 1.0,
+            low_priority_area: float = 0.01,
+            hold_time: float = 2.0,
+            levels: Sequence[DegradationLevel] = DEFAULT_LEVELS,
+            clock: Callable[[], float] = time.monotonic) -> None:
+        """Initialize the controller.
+
+        Args:
+            high_watermark: pending messages above which the link is
+                congested. Defaults to 20.
+            low_watermark: pending messages at or below which the link is
+                clear. Defaults to 5.
+            max_pending: pending messages at which frames are dropped.
+                Defaults to 100.
+            latency_limit: acknowledgement latency in seconds above which
+                the link is congested. The link is clear below half of it.
+                Defaults to 1.0.
+            low_priority_area: faces covering less than this fraction of
+                the frame are low priority. Defaults to 0.01.
+            hold_time: minimum seconds between level changes.
+                Defaults to 2.0.
+            levels: degradation ladder, from normal operation to most
+                degraded. Defaults to DEFAULT_LEVELS.
+            clock: function returning the current time in seconds.
+                Defaults to time.monotonic.
+        """
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.max_pending = max_pending
+        self.latency_limit = latency_limit
+        self.low_priority_area = low_priority_area
+        self.hold_time = hold_time
+        self.levels = list(levels)
+        self.level_index = 0
+        self._clock = clock
+        self._last_change = clock()
+        self._last_publish = float('-inf')
+        self._pending = 0
+
+    @property
+    def level(self) -> DegradationLevel:
+        """Return the current degradation level."""
+        return self.levels[self.level_index]
+
+    def update(self, pending: int, ack_latency: float) -> DegradationLevel:
+        """Update the level from the current state of the link.
+
+        Args:
+            pending: messages waiting to be sent or acknowledged.
+            ack_latency: recent acknowledgement latency in seconds.
+
+        Returns:
+            the degradation level to publish with.
+        """
+        self._pending = pending
+        now = self._clock()
+        if (now - self._last_change < self.hold_time):
+            return self.level
+        congested = (pending > self.high_watermark
+                     or ack_latency > self.latency_limit)
+        clear = (pending <= self.low_watermark
+                 and ack_latency <= self.latency_limit / 2)
+        new_index = self.level_index
+        if (congested):
+            new_index = min(self.level_index + 1, len(self.levels) - 1)
+        elif (clear):
+            new_index = max(self.level_index - 1, 0)
+        if (new_index != self.level_index):
+            print(f'Publish degradation level {self.level_index} -> '
+                  f'{new_index} (pending={pending}, '
+                  f'ack_latency={ack_latency:.2f}s).')
+            self.level_index = new_index
+            self._last_change = now
+        return self.level
+
+    def should_publish(self) -> bool:
+        """Return whether the current frame should be published.
+
+        Records the frame as published when it returns True.
+        """
+        now = self._clock()
+        if (self._pending >= self.max_pending
+                or now - self._last_publish < self.level.min_interval):
+            return False
+        self._last_publish = now
+        return True
+
+    def get_guarantee_level(
+            self,
+            face: Sequence[Union[int, float]],
+            image_shape: Tuple[int, ...],
+            guarantee_level: int) -> int:
+        """Return the guarantee level to publish a face with.
+
+        Args:
+            face: face coordinates (x, y, w, h).
+            image_shape: shape of the frame the face was found in.
+            guarantee_level: configured guarantee level.
+
+        Returns:
+            0 for low-priority faces while degraded, else guarantee_level.
+        """
+        if (not self.level.downgrade_low_priority):
+            return guarantee_level
+        face_area = float(face[2]) * float(face[3])
+        image_area = float(image_shape[0]) * float(image_shape[1])
+        if (face_area < self.low_priority_area * image_area):
+            return 0
+        return guarantee_level
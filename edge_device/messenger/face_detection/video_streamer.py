@@ -15,6 +15,11 @@ class IVideoStreamer(ABC):
         """Start streaming faces."""
         raise NotImplementedError
 
+    @abstractmethod
+    def stop_stream(self) -> None:
+        """Stop a stream started with start_stream after the current frame."""
+        raise NotImplementedError
+
 
 class VideoStreamer(IVideoStreamer):
     """Streams video and outputs detected faces."""
@@ -31,6 +36,7 @@ class VideoStreamer(IVideoStreamer):
         """
         self.video_input = video_input
         self.face_detector = face_detector
+        self._stop_requested = False
 
     def start_stream(self, process_faces: Callable[[
                      np.ndarray, List[List[int]]], None]) -> None:
@@ -40,6 +46,7 @@ class VideoStreamer(IVideoStreamer):
             process_faces (callback): takes input of list of found faces in
                 the frame and performs necessary action.
         """
+        self._stop_requested = False
         capture = cv.VideoCapture(self.video_input)
 
         input_is_str = isinstance(self.video_input, str)
@@ -54,5 +61,15 @@ class VideoStreamer(IVideoStreamer):
                 break
             faces = self.face_detector.get_faces(frame)
             process_faces(frame, faces)
+            if (self._stop_requested):
+                break
 
         capture.release()
+
+    def stop_stream(self) -> None:
+        """Stop the stream after the current frame.
+
+        Only sets a flag, so it is safe to call from a signal handler or
+        another thread.
+        """
+        self._stop_requested = True
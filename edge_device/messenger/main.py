@@ -1,10 +1,19 @@
 """Entrypoint for the face detection package for the edge_device."""
 import argparse
+import signal
+import time
+from functools import partial
 from uuid import uuid4
 from face_detection.face_detector import FaceDetector, IFaceDetector
 from face_detection.neural_face_detector import NeuralFaceDetector
+from face_detection.inference_backend import BACKENDS
 from face_detection.video_streamer import VideoStreamer
-from face_detection.messaging_client import FaceMessenger
+from face_detection.messaging_client import FaceMessenger, MqttClient
+from face_detection.publish_controller import AdaptiveQosController
+from face_detection.batch_processor import BatchProcessor
+from face_detection.detection_filter import create_filtered_detector
+from types import FrameType
+from typing import Callable, List, Optional
 import os
 
 
@@ -18,7 +27,11 @@ class FaceDetectionRunner:
             broker_port: int,
             video_input: int,
             guarantee_level: int,
-            face_detector: IFaceDetector) -> None:
+            face_detector: IFaceDetector,
+            crop_margin: float = 0.0,
+            pad_crops: bool = False,
+            adaptive_qos: bool = False,
+            drain_timeout: float = 8.0) -> None:
         """Initialize the runner.
 
         Args:
@@ -29,18 +42,116 @@ class FaceDetectionRunner:
                 (e.g. 0 for /dev/video0)
             guarantee_level: level of guarantee for message delivery.
                 0 = at most once, 1 = at least once, 2 = exactly once.
+            face_detector: detector used to find faces in frames.
+            crop_margin: fraction of the face size added around each face.
+            pad_crops: pad faces past the frame edge instead of clamping.
+            adaptive_qos: degrade publishing while the broker link is
+                congested.
+            drain_timeout: seconds to wait for queued messages on shutdown.
         """
         video_streamer = VideoStreamer(face_detector, video_input)
+        qos_controller: Optional[AdaptiveQosController] = None
+        if (adaptive_qos):
+            qos_controller = AdaptiveQosController()
         self.messenger = FaceMessenger(
             output_channel,
             broker_host,
             broker_port,
             video_streamer,
-            guarantee_level=guarantee_level)
+            guarantee_level=guarantee_level,
+            crop_margin=crop_margin,
+            pad_crops=pad_crops,
+            qos_controller=qos_controller)
+        self.drain_timeout = drain_timeout
 
     def run(self) -> None:
-        """Run the face detection pipeline."""
-        self.messenger.stream_messages()
+        """Run the face detection pipeline until stopped by a signal."""
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        self.messenger.stream_messages(self.drain_timeout)
+
+    def _stop(self, signal_number: int, _: Optional[FrameType]) -> None:
+        print(f'Received signal {signal_number}. Stopping capture...')
+        self.messenger.stop()
+
+
+class BatchDetectionRunner:
+    """The runner of offline face detection on recorded video files."""
+
+    def __init__(
+            self,
+            video_paths: List[str],
+            output_dir: str,
+            detector_factory: Callable[[], IFaceDetector],
+            workers: Optional[int],
+            chunk_size: int,
+            crop_margin: float = 0.0,
+            pad_crops: bool = False) -> None:
+        """Initialize the runner.
+
+        Args:
+            video_paths: video files to process.
+            output_dir: directory for the metadata index, and for the crops
+                when they are not published.
+            detector_factory: picklable callable creating a face detector
+                in each worker process.
+            workers: number of worker processes (None = one per core).
+            chunk_size: number of frames per worker task.
+            crop_margin: fraction of the face size added around each face.
+            pad_crops: pad faces past the frame edge instead of clamping.
+        """
+        self.video_paths = video_paths
+        self.output_dir = output_dir
+        self.processor = BatchProcessor(
+            detector_factory, workers, chunk_size, crop_margin, pad_crops)
+
+    def run(self) -> None:
+        """Write face crops and the metadata index to output_dir."""
+        start = time.perf_counter()
+        face_count = self.processor.write_to_directory(
+            self.video_paths, self.output_dir)
+        print(f'Wrote {face_count} faces to {self.output_dir} in '
+              f'{time.perf_counter() - start:.1f}s.')
+
+    def publish(
+            self,
+            output_channel: str,
+            broker_host: str,
+            broker_port: int,
+            guarantee_level: int,
+            publish_timeout: float = 60.0,
+            drain_timeout: float = 8.0) -> None:
+        """Publish face crops to the broker and write the metadata index.
+
+        Args:
+            output_channel: the channel to output messages to.
+            broker_host: hostname of the message broker.
+            broker_port: port of the message broker.
+            guarantee_level: level of guarantee for message delivery.
+            publish_timeout: seconds publishing may wait for the broker
+                before giving up.
+            drain_timeout: seconds to wait for queued messages at the end.
+        """
+        start = time.perf_counter()
+        os.makedirs(self.output_dir, exist_ok=True)
+        client = MqttClient()
+        client.connect_async(broker_host, broker_port)
+        client.loop_start()
+        try:
+            face_count = self.processor.publish(
+                self.video_paths, client, output_channel, guarantee_level,
+                os.path.join(self.output_dir, 'index.jsonl'),
+                timeout=publish_timeout)
+            deadline = time.monotonic() + drain_timeout
+            while (client.pending_count() > 0
+                   and time.monotonic() < deadline):
+                time.sleep(0.1)
+        finally:
+            client.loop_stop()
+            client.disconnect()
+        print(f'Published {face_count} faces to {output_channel} in '
+              f'{time.perf_counter() - start:.1f}s, '
+              f'{client.pending_count()} not acknowledged.')
 
 
 if(__name__ == "__main__"):
@@ -49,15 +160,18 @@ if(__name__ == "__main__"):
     client_id = uuid4()
     print(f'Face detection client started for client_id={client_id}')
     arg_parser = argparse.ArgumentParser(
-        description="Run the face detection pipeline.")
+        description="Run the face detection pipeline.", add_help=False)
+    arg_parser.add_argument(
+        '--help', action='help',
+        help='Show this help message and exit.')
     arg_parser.add_argument(
         '-c', '--channel', type=str, default=f'faces/{client_id}',
         help='Output channel to be used for publishing messages.')
     arg_parser.add_argument(
-        '-b', '--broker', type=str, required=True,
+        '-b', '--broker', type=str,
         help='Hostname of the message broker.')
     arg_parser.add_argument(
-        '-p', '--port', type=int, required=True,
+        '-p', '--port', type=int,
         help='Port on the broker host to publish messages to.')
     arg_parser.add_argument(
         '-v', '--video', type=int, default=0,
@@ -72,30 +186,155 @@ if(__name__ == "__main__"):
         '-f', '--detector_path', type=str,
         help='Path to detector saved graph.')
     arg_parser.add_argument(
-        '-w', '--width', type=str,
+        '-w', '--width', type=int,
         help='Input image width for detector.')
     arg_parser.add_argument(
-        '-h', '--height', type=str,
+        '-h', '--height', type=int,
         help='Input image height for detector.')
+    arg_parser.add_argument(
+        '--backend', type=str, default='tensorflow',
+        choices=BACKENDS,
+        help='Inference backend used by the neural face detector.')
+    arg_parser.add_argument(
+        '--detector_config', type=str, default='',
+        help='Network description for the opencv backend.')
+    arg_parser.add_argument(
+        '--dnn_scale_factor', type=float, default=1.0,
+        help='Multiplier applied to pixels by the opencv backend.')
+    arg_parser.add_argument(
+        '--dnn_mean', type=float, nargs=3, default=[0.0, 0.0, 0.0],
+        help='Per-channel mean subtracted by the opencv backend '
+             '(104 177 123 for res10).')
+    arg_parser.add_argument(
+        '--optimize_graph', action='store_true',
+        help='Strip unused nodes and fold constants in the neural graph.')
+    arg_parser.add_argument(
+        '--warmup_runs', type=int, default=0,
+        help='Number of warm-up inferences to run when loading the graph.')
+    arg_parser.add_argument(
+        '--intra_op_threads', type=int, default=0,
+        help='Threads used inside a single op (0 = Tensorflow default, or '
+             'the cores shared between batch workers).')
+    arg_parser.add_argument(
+        '--inter_op_threads', type=int, default=0,
+        help='Threads used to run independent ops (0 = Tensorflow default, '
+             'or 1 per batch worker).')
+    arg_parser.add_argument(
+        '--crop_margin', type=float, default=0.0,
+        help='Fraction of the face size added around each face crop.')
+    arg_parser.add_argument(
+        '--pad_crops', action='store_true',
+        help='Pad faces past the frame edge instead of clamping them.')
+    arg_parser.add_argument(
+        '--adaptive_qos', action='store_true',
+        help='Lower publish rate, crop size and QoS under backpressure.')
+    arg_parser.add_argument(
+        '--nms_iou', type=float,
+        help='Drop faces overlapping a better face by more than this IoU.')
+    arg_parser.add_argument(
+        '--top_k', type=int, default=0,
+        help='Maximum number of faces per frame (0 = no limit).')
+    arg_parser.add_argument(
+        '--min_face_size', type=int, default=0,
+        help='Minimum face width and height in pixels.')
+    arg_parser.add_argument(
+        '--haar_fusion', action='store_true',
+        help='Only run the neural detector around Haar cascade faces.')
+    arg_parser.add_argument(
+        '--fusion_interval', type=int, default=30,
+        help='Frames between full-frame neural runs with --haar_fusion.')
+    arg_parser.add_argument(
+        '--drain_timeout', type=float, default=8.0,
+        help='Seconds to wait for queued messages on shutdown.')
+    arg_parser.add_argument(
+        '-i', '--batch_input', type=str, nargs='+',
+        help='Video files to process offline instead of the video camera.')
+    arg_parser.add_argument(
+        '-o', '--output_dir', type=str, default='faces',
+        help='Directory for batch crops and the metadata index.')
+    arg_parser.add_argument(
+        '--batch_publish', action='store_true',
+        help='Publish batch crops to the broker instead of output_dir.')
+    arg_parser.add_argument(
+        '--workers', type=int,
+        help='Number of batch worker processes (default one per core).')
+    arg_parser.add_argument(
+        '--chunk_size', type=int, default=300,
+        help='Number of frames per batch worker task.')
+    arg_parser.add_argument(
+        '--publish_timeout', type=float, default=60.0,
+        help='Seconds batch publishing waits for the broker before failing.')
     args = arg_parser.parse_args()
-    face_detector: IFaceDetector
+    intra_op_threads = args.intra_op_threads
+    inter_op_threads = args.inter_op_threads
+    if (args.batch_input is not None):
+        # every batch worker runs its own detector, so the runtime default of
+        # one thread per core would oversubscribe the cpu
+        cpu_count = os.cpu_count() or 1
+        workers = args.workers or cpu_count
+        intra_op_threads = intra_op_threads or max(cpu_count // workers, 1)
+        inter_op_threads = inter_op_threads or 1
+    detector_factory: Callable[[], IFaceDetector]
     if (args.detector == 'neural'):
         assert args.detector_path is not None
         assert args.width is not None
         assert args.height is not None
-        face_detector = NeuralFaceDetector(
-            args.detector_path, (args.width, args.height))
+        detector_factory = partial(
+            NeuralFaceDetector,
+            args.detector_path, (args.width, args.height),
+            optimize_graph=args.optimize_graph,
+            warmup_runs=args.warmup_runs,
+            intra_op_threads=intra_op_threads,
+            inter_op_threads=inter_op_threads,
+            backend=args.backend,
+            config_path=args.detector_config,
+            dnn_scale_factor=args.dnn_scale_factor,
+            dnn_mean=tuple(args.dnn_mean))
     else:
         if (args.detector_path is not None):
-            face_detector = FaceDetector(args.detector_path)
+            detector_factory = partial(FaceDetector, args.detector_path)
         else:
-            face_detector = FaceDetector()
-
-    runner = FaceDetectionRunner(
-        args.channel,
-        args.broker,
-        args.port,
-        args.video,
-        args.guarantee,
-        face_detector)
-    runner.run()
+            detector_factory = FaceDetector
+    if (args.haar_fusion or args.nms_iou is not None or args.top_k > 0
+            or args.min_face_size > 0):
+        detector_factory = partial(
+            create_filtered_detector,
+            detector_factory,
+            args.nms_iou if args.nms_iou is not None else 0.3,
+            args.top_k,
+            args.min_face_size,
+            FaceDetector if args.haar_fusion else None,
+            args.fusion_interval)
+
+    if (args.batch_input is not None):
+        batch_runner = BatchDetectionRunner(
+            args.batch_input,
+            args.output_dir,
+            detector_factory,
+            args.workers,
+            args.chunk_size,
+            args.crop_margin,
+            args.pad_crops)
+        if (args.batch_publish):
+            assert args.broker is not None
+            assert args.port is not None
+            batch_runner.publish(
+                args.channel, args.broker, args.port, args.guarantee,
+                args.publish_timeout, args.drain_timeout)
+        else:
+            batch_runner.run()
+    else:
+        assert args.broker is not None
+        assert args.port is not None
+        runner = FaceDetectionRunner(
+            args.channel,
+            args.broker,
+            args.port,
+            args.video,
+            args.guarantee,
+            detector_factory(),
+            args.crop_margin,
+            args.pad_crops,
+            args.adaptive_qos,
+            args.drain_timeout)
+        runner.run()
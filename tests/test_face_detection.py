@@ -1,19 +1,32 @@
 """Tests for the face_detection package."""
 import numpy as np
-from typing import List, Callable
+from typing import Any, Dict, List, Callable, Optional, Tuple, Union
+import json
 import pathlib
+import sys
+import types
 import pytest
 from math import isclose
 from os import path
 from edge_device.messenger.face_detection.face_detector import (
-    FaceDetector, IFaceDetector)
+    FaceDetector, IFaceDetector, IScoredFaceDetector)
 from edge_device.messenger.face_detection.messaging_client import (
-    IMessagingClient, FaceMessenger)
+    IMessagingClient, FaceMessenger, MqttClient)
 from edge_device.messenger.face_detection.video_streamer import (
     IVideoStreamer, VideoStreamer)
 from edge_device.messenger.face_detection.neural_face_detector import (
     NeuralFaceDetector)
+from edge_device.messenger.face_detection.inference_backend import (
+    IInferenceBackend, OpenCVDnnBackend, TFLiteBackend)
+from edge_device.messenger.face_detection.face_cropper import FaceCropper
+from edge_device.messenger.face_detection.publish_controller import (
+    AdaptiveQosController, DegradationLevel)
+from edge_device.messenger.face_detection.batch_processor import (
+    BatchProcessor)
+from edge_device.messenger.face_detection.detection_filter import (
+    CascadeFusionDetector, FilteredFaceDetector, non_max_suppression)
 import cv2 as cv
+import paho.mqtt.client as mqtt
 
 
 class MockFaceDetector(IFaceDetector):
@@ -24,6 +37,115 @@ class MockFaceDetector(IFaceDetector):
         return [[1]]
 
 
+class MockBoxDetector(IFaceDetector):
+    """Mock for IFaceDetector returning a fixed face for non-blank frames."""
+
+    def get_faces(self, image: np.ndarray) -> List[List[int]]:
+        """Return one face if the frame is not blank."""
+        return [[10, 20, 30, 40]] if image.mean() > 0 else []
+
+
+class MockScoredFaceDetector(IScoredFaceDetector):
+    """Mock for IScoredFaceDetector returning fixed faces and scores."""
+
+    def __init__(
+            self,
+            faces: List[List[int]],
+            scores: List[float]) -> None:
+        """Initialize faces and scores and record the images seen."""
+        self.faces = faces
+        self.scores = scores
+        self.image_shapes: List[Tuple[int, ...]] = []
+
+    def get_faces(self, image: np.ndarray) -> List[List[int]]:
+        """Return the configured faces."""
+        return self.get_scored_faces(image)[0]
+
+    def get_scored_faces(
+            self,
+            image: np.ndarray) -> Tuple[List[List[int]], List[float]]:
+        """Record the image shape and return the configured faces."""
+        self.image_shapes.append(image.shape)
+        return self.faces, self.scores
+
+
+class MockInferenceBackend(IInferenceBackend):
+    """Mock for IInferenceBackend interface."""
+
+    def __init__(self, boxes: np.ndarray, scores: np.ndarray) -> None:
+        """Initialize boxes and scores returned by detect."""
+        self.boxes = boxes
+        self.scores = scores
+        self.input_shapes: List[Tuple[int, ...]] = []
+
+    def detect(self, image: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Record the input shape and return the configured detections."""
+        self.input_shapes.append(image.shape)
+        return self.boxes, self.scores
+
+    def close(self) -> None:
+        """Nothing to release."""
+
+
+class MockTFLiteInterpreter:
+    """Mock for a TFLite interpreter with a quantized boxes output."""
+
+    input_dtype: Any = np.float32
+
+    def __init__(self, model_path: str, num_threads: Optional[int]) -> None:
+        """Initialize the tensors."""
+        self.tensors: Dict[int, np.ndarray] = {
+            1: np.array([[[0, 51, 102, 255]]], dtype=np.uint8),
+            2: np.array([[0.9]], dtype=np.float32)}
+
+    def allocate_tensors(self) -> None:
+        """Nothing to allocate."""
+
+    def get_input_details(self) -> List[Dict[str, Any]]:
+        """Return the input tensor with the configured type."""
+        return [{'index': 0, 'dtype': self.input_dtype,
+                 'quantization': (1 / 255.0, 0)}]
+
+    def get_output_details(self) -> List[Dict[str, Any]]:
+        """Return a quantized boxes tensor and a float scores tensor."""
+        return [{'index': 1, 'quantization': (1 / 255.0, 0)},
+                {'index': 3, 'quantization': (0.0, 0)},
+                {'index': 2, 'quantization': (0.0, 0)}]
+
+    def set_tensor(self, index: int, value: np.ndarray) -> None:
+        """Record the tensor."""
+        self.tensors[index] = value
+
+    def invoke(self) -> None:
+        """Nothing to run."""
+
+    def get_tensor(self, index: int) -> np.ndarray:
+        """Return the recorded tensor."""
+        return self.tensors[index]
+
+
+class MockDnnNet:
+    """Mock for a cv.dnn network recording its input blob."""
+
+    def __init__(self) -> None:
+        """Initialize without an input."""
+        self.blob = np.zeros(0)
+
+    def setPreferableBackend(self, backend: int) -> None:
+        """Ignore the backend."""
+
+    def setPreferableTarget(self, target: int) -> None:
+        """Ignore the target."""
+
+    def setInput(self, blob: np.ndarray) -> None:
+        """Record the input blob."""
+        self.blob = blob
+
+    def forward(self) -> np.ndarray:
+        """Return one detection covering the whole image."""
+        return np.array([[[[0, 1, 0.9, 0.0, 0.0, 1.0, 1.0]]]])
+
+
 class MockVideoStreamer(IVideoStreamer):
     """Mock for IVideoStreamer interface."""
 
@@ -37,6 +159,9 @@ class MockVideoStreamer(IVideoStreamer):
         """Start streaming faces."""
         process_faces(self.test_image, self.test_faces)
 
+    def stop_stream(self) -> None:
+        """Nothing to stop, the stream ends after one frame."""
+
 
 class MockMessagingClient(IMessagingClient):
     """Mock for IMessagingClient interface."""
@@ -48,6 +173,9 @@ class MockMessagingClient(IMessagingClient):
         self.looping = False
         self.hostname = hostname
         self.port = port
+        self.pending = 0
+        self.latency = 0.0
+        self.accepting = True
 
     def connect_async(self, hostname: str, port: int) -> None:
         """Set self.connected to True if host and port match."""
@@ -66,15 +194,30 @@ class MockMessagingClient(IMessagingClient):
         """Set self.looping to False."""
         self.looping = False
 
+    def is_connected(self) -> bool:
+        """Return self.connected."""
+        return self.connected
+
     def publish(
             self,
             output_channel: str,
-            message: str,
-            guarantee_level: int) -> None:
-        """Publish message to messages array."""
+            message: Union[bytes, memoryview],
+            guarantee_level: int) -> bool:
+        """Publish message to messages array unless accepting is False."""
+        if (not self.accepting):
+            return False
         self.messages.append(
             f'channel: {output_channel}, qos: {guarantee_level}'
-            + f', message: {message}')
+            + f', message: {bytes(message)}')
+        return True
+
+    def pending_count(self) -> int:
+        """Return the configured pending count."""
+        return self.pending
+
+    def ack_latency(self) -> float:
+        """Return the configured acknowledgement latency."""
+        return self.latency
 
 
 class TestFaceDetector:
@@ -113,6 +256,164 @@ class TestNeuralFaceDetector:
             for expected_val, actual_val in zip(expected_face, actual_face):
                 assert isclose(actual_val, expected_val, abs_tol=2)
 
+    def test_optimized_warm_up(self) -> None:
+        """Test that warm-up and graph optimization keep detections."""
+        test_file_path = pathlib.Path(__file__).parent.absolute()
+        image_path = str(test_file_path / 'test_faces.jpg')
+        graph_path = str(test_file_path / 'frozen_inference_graph_face.pb')
+        detector = NeuralFaceDetector(
+            graph_path, (300, 300), optimize_graph=True, warmup_runs=3,
+            intra_op_threads=1, inter_op_threads=1)
+        assert detector.warmup_latency is not None
+        assert detector.warmup_latency > 0
+        faces = detector.get_faces(image_path)
+        assert len(faces) == 2
+
+    def test_opencv_backend_mean(
+            self,
+            monkeypatch: pytest.MonkeyPatch) -> None:
+        """Test that the mean and scale reach the opencv backend."""
+        net = MockDnnNet()
+        monkeypatch.setattr(cv.dnn, 'readNet', lambda *args: net)
+        detector = NeuralFaceDetector(
+            'res10.caffemodel', (4, 4), backend='opencv',
+            config_path='deploy.prototxt', dnn_scale_factor=0.5,
+            dnn_mean=(104.0, 177.0, 123.0))
+        faces = detector.get_faces(np.full((4, 4, 3), 200, dtype=np.uint8))
+        assert faces == [[0, 0, 4, 4]]
+        assert np.allclose(net.blob[0, :, 0, 0], [48.0, 11.5, 38.5])
+
+    def test_opencv_backend_without_read_net(
+            self,
+            monkeypatch: pytest.MonkeyPatch) -> None:
+        """Test that OpenCV 3.3 style loaders are used without readNet."""
+        net = MockDnnNet()
+        loaded: List[Tuple[str, ...]] = []
+
+        def read_net_from_caffe(*args: str) -> MockDnnNet:
+            loaded.append(args)
+            return net
+        monkeypatch.delattr(cv.dnn, 'readNet')
+        monkeypatch.delattr(cv.dnn, 'DNN_BACKEND_OPENCV')
+        monkeypatch.setattr(
+            cv.dnn, 'readNetFromCaffe', read_net_from_caffe, raising=False)
+        detector = NeuralFaceDetector(
+            'res10.caffemodel', (4, 4), backend='opencv',
+            config_path='deploy.prototxt')
+        assert loaded == [('deploy.prototxt', 'res10.caffemodel')]
+        assert detector.get_faces(
+            np.zeros((4, 4, 3), dtype=np.uint8)) == [[0, 0, 4, 4]]
+        with pytest.raises(ValueError):
+            OpenCVDnnBackend('face.onnx')
+
+    def test_backend_boxes(self) -> None:
+        """Test that backend boxes are thresholded and scaled to the image."""
+        backend = MockInferenceBackend(
+            np.array([[0.1, 0.2, 0.5, 0.6], [0.0, 0.0, 0.1, 0.1]]),
+            np.array([0.9, 0.1]))
+        detector = NeuralFaceDetector(
+            '', (300, 200), backend=backend, warmup_runs=2)
+        assert detector.warmup_latency is not None
+        faces = detector.get_faces(np.zeros((100, 200, 3), dtype=np.uint8))
+        assert backend.input_shapes[-1] == (200, 300, 3)
+        assert len(faces) == 1
+        for expected_val, actual_val in zip([40, 10, 80, 40], faces[0]):
+            assert isclose(actual_val, expected_val, abs_tol=1e-4)
+
+
+class TestInferenceBackend:
+    """Tests for the inference_backend module."""
+
+    def test_tflite_input_types(
+            self,
+            monkeypatch: pytest.MonkeyPatch) -> None:
+        """Test that pixels are fed as the input type expects."""
+        interpreter_module = types.ModuleType('tflite_runtime.interpreter')
+        setattr(interpreter_module, 'Interpreter', MockTFLiteInterpreter)
+        monkeypatch.setitem(
+            sys.modules, 'tflite_runtime', types.ModuleType('tflite_runtime'))
+        monkeypatch.setitem(
+            sys.modules, 'tflite_runtime.interpreter', interpreter_module)
+        pixels = np.array([0, 64, 128, 200, 255], dtype=np.uint8)
+        image = np.repeat(pixels[None, :, None], 3, axis=2)
+        cases: List[Tuple[Any, np.ndarray]] = [
+            (np.uint8, pixels),
+            (np.int8, pixels.astype(np.int16) - 128),
+            (np.float32, (pixels - 127.5) / 127.5)]
+        for input_dtype, expected in cases:
+            monkeypatch.setattr(
+                MockTFLiteInterpreter, 'input_dtype', input_dtype)
+            backend = TFLiteBackend('model.tflite')
+            boxes, scores = backend.detect(image)
+            model_input = backend._interpreter.get_tensor(0)
+            assert model_input.dtype == input_dtype
+            assert model_input.shape == (1, 1, 5, 3)
+            assert np.allclose(model_input[0, 0, :, 0], expected)
+            assert np.allclose(boxes, [[0.0, 0.2, 0.4, 1.0]])
+            assert np.allclose(scores, [0.9])
+
+
+class TestDetectionFilter:
+    """Tests for the detection_filter module."""
+
+    def test_non_max_suppression(self) -> None:
+        """Test that overlapping faces are suppressed by score."""
+        faces = np.array([
+            [0, 0, 10, 10], [1, 1, 10, 10], [20, 20, 10, 10],
+            [50, 50, 5, 5]], dtype=np.float64)
+        scores = np.array([0.5, 0.9, 0.7, 0.6])
+        kept = non_max_suppression(faces, scores, 0.3)
+        assert kept.tolist() == [1, 2, 3]
+        kept = non_max_suppression(faces, scores, 0.3, top_k=2)
+        assert kept.tolist() == [1, 2]
+        assert len(non_max_suppression(np.zeros((0, 4)), np.zeros(0), 0.3)) \
+            == 0
+
+    def test_filtered_detector(self) -> None:
+        """Test that small and overlapping faces are removed."""
+        detector = MockScoredFaceDetector(
+            [[0, 0, 10, 10], [1, 1, 10, 10], [20, 20, 2, 2]],
+            [0.5, 0.9, 0.99])
+        filtered = FilteredFaceDetector(detector, min_size=5)
+        faces = filtered.get_faces(np.zeros((40, 40, 3), dtype=np.uint8))
+        assert faces == [[1, 1, 10, 10]]
+
+    def test_filtered_unscored_detector(self) -> None:
+        """Test that faces of unscored detectors are ranked by area."""
+        class UnscoredDetector(IFaceDetector):
+            def get_faces(self, image: np.ndarray) -> List[List[int]]:
+                return [[0, 0, 8, 8], [0, 0, 10, 10]]
+
+        filtered = FilteredFaceDetector(UnscoredDetector())
+        faces = filtered.get_faces(np.zeros((40, 40, 3), dtype=np.uint8))
+        assert faces == [[0, 0, 10, 10]]
+
+    def test_cascade_fusion(self) -> None:
+        """Test that the detector only runs on candidate regions."""
+        image = np.zeros((100, 100, 3), dtype=np.uint8)
+        candidates = MockScoredFaceDetector(
+            [[40, 40, 20, 20], [42, 42, 20, 20]], [1.0, 0.5])
+        detector = MockScoredFaceDetector([[5, 5, 10, 10]], [0.9])
+        fused = CascadeFusionDetector(
+            candidates, detector, margin=0.5, full_frame_interval=2)
+        assert fused.get_faces(image) == [[5, 5, 10, 10]]
+        assert detector.image_shapes == [(100, 100, 3)]
+        assert fused.get_faces(image) == [[35, 35, 10, 10]]
+        assert detector.image_shapes[1:] == [(40, 40, 3)]
+        candidates.faces, candidates.scores = [], []
+        fused.get_faces(image)
+        assert fused.get_faces(image) == []
+        assert len(detector.image_shapes) == 3
+
+    def test_cascade_fusion_missing_image(
+            self,
+            tmp_path: pathlib.Path) -> None:
+        """Test that an unreadable image path raises FileNotFoundError."""
+        fused = CascadeFusionDetector(
+            MockScoredFaceDetector([], []), MockScoredFaceDetector([], []))
+        with pytest.raises(FileNotFoundError):
+            fused.get_faces(str(tmp_path / 'missing.jpg'))
+
 
 class TestVideoStreamer:
     """Tests for the video_streamer module."""
@@ -130,6 +431,108 @@ class TestVideoStreamer:
         streamer = VideoStreamer(face_detector, test_video_path)
         streamer.start_stream(self._mock_callback)
 
+    def test_stop_stream(self) -> None:
+        """Test that stop_stream ends the stream after the current frame."""
+        test_file_path = pathlib.Path(__file__).parent.absolute()
+        test_video_path = str(test_file_path / 'test_video.avi')
+        streamer = VideoStreamer(MockFaceDetector(), test_video_path)
+        frames: List[np.ndarray] = []
+
+        def stop_after_two_frames(
+                frame: np.ndarray, faces: List[List[int]]) -> None:
+            frames.append(frame)
+            if (len(frames) == 2):
+                streamer.stop_stream()
+
+        streamer.start_stream(stop_after_two_frames)
+        assert len(frames) == 2
+
+
+class TestBatchProcessor:
+    """Tests for the batch_processor module."""
+
+    def test_split(self) -> None:
+        """Test that videos are split into chunks read to the end."""
+        test_file_path = pathlib.Path(__file__).parent.absolute()
+        test_video_path = str(test_file_path / 'test_video.avi')
+        processor = BatchProcessor(MockBoxDetector, chunk_size=7)
+        frame_ranges = processor.split([test_video_path])
+        assert [(frame_range.start, frame_range.end)
+                for frame_range in frame_ranges] == [(0, 7), (7, 14), (14, -1)]
+
+    def test_write_to_directory(self, tmp_path: pathlib.Path) -> None:
+        """Test that output does not depend on the number of workers."""
+        test_file_path = pathlib.Path(__file__).parent.absolute()
+        video_paths = [
+            str(test_file_path / 'test_video.avi'),
+            str(test_file_path / 'test_video_no_faces.avi')]
+        indexes: List[str] = []
+        for workers in [1, 3]:
+            output_dir = tmp_path / str(workers)
+            processor = BatchProcessor(
+                MockBoxDetector, workers, chunk_size=7)
+            face_count = processor.write_to_directory(
+                video_paths, str(output_dir))
+            index = (output_dir / 'index.jsonl').read_text()
+            assert len(index.splitlines()) == face_count
+            first_record = json.loads(index.splitlines()[0])
+            assert first_record['frame'] == 0
+            assert first_record['box'] == [10, 20, 30, 40]
+            assert (output_dir / first_record['file']).exists()
+            indexes.append(index)
+        assert indexes[0] == indexes[1]
+
+    def test_publish(self, tmp_path: pathlib.Path) -> None:
+        """Test that crops are published in order with bounded ranges."""
+        test_file_path = pathlib.Path(__file__).parent.absolute()
+        video_paths = [str(test_file_path / 'test_video.avi')]
+        messaging_client = MockMessagingClient('localhost', 1234)
+        messaging_client.connect_async('localhost', 1234)
+        processor = BatchProcessor(
+            MockBoxDetector, 2, chunk_size=7, max_in_flight=1)
+        index_path = tmp_path / 'index.jsonl'
+        face_count = processor.publish(
+            video_paths, messaging_client, 'faces', 1, str(index_path))
+        assert face_count > 0
+        assert len(messaging_client.messages) == face_count
+        assert messaging_client.messages[0].startswith(
+            'channel: faces, qos: 1')
+        frames = [json.loads(line)['frame']
+                  for line in index_path.read_text().splitlines()]
+        assert frames == sorted(frames)
+
+    def test_publish_timeout(self) -> None:
+        """Test that publishing gives up if the broker never catches up."""
+        test_file_path = pathlib.Path(__file__).parent.absolute()
+        video_paths = [str(test_file_path / 'test_video.avi')]
+        messaging_client = MockMessagingClient('localhost', 1234)
+        messaging_client.connect_async('localhost', 1234)
+        messaging_client.pending = 10
+        processor = BatchProcessor(MockBoxDetector, 1, chunk_size=7)
+        with pytest.raises(TimeoutError):
+            processor.publish(
+                video_paths, messaging_client, 'faces', max_pending=10,
+                timeout=0.1)
+        assert len(messaging_client.messages) == 0
+
+    def test_publish_not_accepted(self) -> None:
+        """Test that crops are not counted until the client accepts them."""
+        test_file_path = pathlib.Path(__file__).parent.absolute()
+        video_paths = [str(test_file_path / 'test_video.avi')]
+        processor = BatchProcessor(MockBoxDetector, 1, chunk_size=7)
+        disconnected_client = MockMessagingClient('localhost', 1234)
+        with pytest.raises(TimeoutError, match='not connected'):
+            processor.publish(
+                video_paths, disconnected_client, 'faces', 0, timeout=0.1)
+        assert len(disconnected_client.messages) == 0
+        dropping_client = MockMessagingClient('localhost', 1234)
+        dropping_client.connect_async('localhost', 1234)
+        dropping_client.accepting = False
+        with pytest.raises(TimeoutError):
+            processor.publish(
+                video_paths, dropping_client, 'faces', 0, timeout=0.1)
+        assert len(dropping_client.messages) == 0
+
 
 class TestMessagingClient:
     """Tests for the messaging_client module."""
@@ -179,3 +582,164 @@ class TestMessagingClient:
             f', qos: {guarantee_level}' + \
             f', message: {face_2_png.tobytes()}'
         assert face_2_message == messaging_client.messages[1]
+
+    def test_stream_float_faces(self) -> None:
+        """Test that float faces past the frame edge are clamped."""
+        host = 'localhost'
+        port = 1234
+        test_image = self._initialize_test_image()
+        # detectors can return float boxes
+        test_faces: List[List[Any]] = [
+            [2.4, 1.6, 5.0, 5.0], [5.0, 5.0, 1.0, 1.0]]
+        video_streamer = MockVideoStreamer(test_image, test_faces)
+        messaging_client = MockMessagingClient(host, port)
+        messenger = FaceMessenger(
+            'test', host, port, video_streamer, messaging_client)
+        messenger.stream_messages()
+
+        assert len(messaging_client.messages) == 1
+        _, face_png = cv.imencode('.png', test_image[2:4, 2:4])
+        assert messaging_client.messages[0].endswith(
+            f'message: {face_png.tobytes()}')
+
+    def test_stream_faces_under_backpressure(self) -> None:
+        """Test that small faces drop to QoS 0 and full queues drop frames."""
+        host = 'localhost'
+        port = 1234
+        test_image = self._initialize_test_image(20)
+        test_faces = [[0, 0, 10, 10], [12, 12, 2, 2]]
+        video_streamer = MockVideoStreamer(test_image, test_faces)
+        messaging_client = MockMessagingClient(host, port)
+        controller = AdaptiveQosController(
+            high_watermark=2, max_pending=10, low_priority_area=0.05,
+            hold_time=0.0)
+        messenger = FaceMessenger(
+            'test', host, port, video_streamer, messaging_client, 1,
+            qos_controller=controller)
+        messaging_client.pending = 5
+        messenger.stream_messages(drain_timeout=0.0)
+        assert controller.level_index == 1
+        assert messaging_client.messages[0].startswith(
+            'channel: test, qos: 1')
+        assert messaging_client.messages[1].startswith(
+            'channel: test, qos: 0')
+
+        messaging_client.pending = 10
+        messenger.stream_messages(drain_timeout=0.0)
+        assert len(messaging_client.messages) == 2
+
+    def test_forget_qos0_on_disconnect(
+            self,
+            monkeypatch: pytest.MonkeyPatch) -> None:
+        """Test that QoS 0 messages lost on disconnect stop being pending."""
+        client = MqttClient()
+        mids = iter(range(1, 10))
+        monkeypatch.setattr(
+            client._client, 'publish',
+            lambda *args: mqtt.MQTTMessageInfo(next(mids)))
+        client.publish('test', b'qos 0', 0)
+        client.publish('test', b'qos 1', 1)
+        assert client.pending_count() == 2
+        client._on_disconnect(client._client, None, 1)
+        assert client.pending_count() == 1
+        client.publish('test', b'qos 0', 0)
+        client._on_connect(client._client, None, {}, 0)
+        assert client.pending_count() == 1
+
+    def test_drain(self) -> None:
+        """Test that messages still pending at the deadline are abandoned."""
+        host = 'localhost'
+        port = 1234
+        video_streamer = MockVideoStreamer(self._initialize_test_image(), [])
+        messaging_client = MockMessagingClient(host, port)
+        messenger = FaceMessenger(
+            'test', host, port, video_streamer, messaging_client)
+        messaging_client.pending = 3
+        assert messenger.drain(0.1) == (0, 3)
+        messaging_client.pending = 0
+        assert messenger.drain(0.1) == (0, 0)
+
+
+class TestAdaptiveQosController:
+    """Tests for the publish_controller module."""
+
+    def test_degrade_and_recover(self) -> None:
+        """Test that levels change one step per hold_time."""
+        now = [0.0]
+        levels = [
+            DegradationLevel(0.0, 1.0, False),
+            DegradationLevel(1.0, 0.5, True)]
+        controller = AdaptiveQosController(
+            high_watermark=10, low_watermark=2, latency_limit=1.0,
+            hold_time=5.0, levels=levels, clock=lambda: now[0])
+        now[0] = 5.0
+        assert controller.update(0, 2.0) == levels[1]
+        now[0] = 6.0
+        assert controller.update(0, 0.0) == levels[1]
+        assert controller.should_publish()
+        now[0] = 6.5
+        assert not controller.should_publish()
+        now[0] = 7.0
+        assert controller.should_publish()
+        now[0] = 10.0
+        assert controller.update(5, 0.0) == levels[1]
+        assert controller.update(2, 0.6) == levels[1]
+        assert controller.update(2, 0.5) == levels[0]
+
+
+class TestFaceCropper:
+    """Tests for the face_cropper module."""
+
+    def test_crop_margin(self) -> None:
+        """Test that margins expand the crop and are clamped to the frame."""
+        image = np.arange(100, dtype=np.uint8).reshape(10, 10)
+        cropper = FaceCropper(margin=0.5)
+        cut_image = cropper.crop(image, [1.2, 4, 4, 2])
+        assert cut_image is not None
+        assert np.array_equal(cut_image, image[3:7, 0:7])
+        assert np.shares_memory(cut_image, image)
+
+    def test_crop_padding(self) -> None:
+        """Test that padded crops keep their size and reuse the buffer."""
+        image = np.full((10, 10, 3), 255, dtype=np.uint8)
+        cropper = FaceCropper(margin=0.5, pad=True)
+        first_cut = cropper.crop(image, [0, 0, 4, 4])
+        assert first_cut is not None
+        assert first_cut.shape == (8, 8, 3)
+        assert np.all(first_cut[:2, :] == 0)
+        assert np.all(first_cut[2:, 2:] == 255)
+        second_cut = cropper.crop(image, [8, 8, 2, 2])
+        assert second_cut is not None
+        assert second_cut.shape == (4, 4, 3)
+        assert np.shares_memory(first_cut, second_cut)
+
+    def test_crop_outside_frame(self) -> None:
+        """Test that faces outside the frame are skipped."""
+        image = np.zeros((10, 10), dtype=np.uint8)
+        assert FaceCropper().crop(image, [20, 20, 5, 5]) is None
+
+    def test_encode(self) -> None:
+        """Test that encoded crops decode back to the crop."""
+        image = np.arange(100, dtype=np.uint8).reshape(10, 10)
+        cropper = FaceCropper()
+        cut_image = cropper.crop(image, [2, 3, 4, 5])
+        assert cut_image is not None
+        encoded = cropper.encode(cut_image)
+        assert isinstance(encoded, memoryview)
+        decoded = cv.imdecode(
+            np.frombuffer(encoded, dtype=np.uint8), cv.IMREAD_UNCHANGED)
+        assert decoded is not None
+        assert np.array_equal(decoded, image[3:8, 2:6])
+
+    def test_encode_scaled_narrow_crop(self) -> None:
+        """Test that scaling keeps at least one pixel on each side."""
+        image = np.arange(100, dtype=np.uint8).reshape(10, 10)
+        cropper = FaceCropper()
+        cut_image = cropper.crop(image, [9, 2, 5, 5])
+        assert cut_image is not None
+        assert cut_image.shape == (5, 1)
+        encoded = cropper.encode(cut_image, scale=0.5)
+        decoded = cv.imdecode(
+            np.frombuffer(encoded, dtype=np.uint8), cv.IMREAD_UNCHANGED)
+        assert decoded is not None
+        assert decoded.shape == (2, 1)
@@ -0,0 +1,232 @@
+"""Tests for the message_processing package."""
+import threading
+import time
+import numpy as np
+from typing import List, Optional, Tuple
+import cv2 as cv
+import paho.mqtt.client as mqtt
+from cloud_server.message_processor.message_processing.face_index import (
+    FaceDeduplicator, FaceEmbedder, FaceIndex)
+from cloud_server.message_processor.message_processing.message_saver import (
+    MessageSaver)
+from cloud_server.message_processor.message_processing.processing_client \
+    import ProcessingClient
+
+
+class MockMessageSaver(MessageSaver):
+    """Mock for MessageSaver recording stored objects."""
+
+    def __init__(self) -> None:
+        """Initialize without connecting to cloud object storage."""
+        self.objects: List[Tuple[str, str, bytes]] = []
+
+    def store_object(
+            self,
+            message: bytes,
+            object_name: str,
+            bucket_name: str) -> None:
+        """Record the stored object."""
+        self.objects.append((bucket_name, object_name, message))
+
+
+class SlowMessageSaver(MockMessageSaver):
+    """Mock for MessageSaver that blocks until released."""
+
+    def __init__(self) -> None:
+        """Initialize the release event."""
+        super().__init__()
+        self.release = threading.Event()
+
+    def store_object(
+            self,
+            message: bytes,
+            object_name: str,
+            bucket_name: str) -> None:
+        """Wait for release, then record the stored object."""
+        self.release.wait(5.0)
+        super().store_object(message, object_name, bucket_name)
+
+
+class MockFaceEmbedder(FaceEmbedder):
+    """Mock for FaceEmbedder using the mean color of the face."""
+
+    def __init__(self) -> None:
+        """Initialize without loading a model."""
+        self.dimension = 3
+
+    def embed(self, message: bytes) -> Optional[np.ndarray]:
+        """Return the mean color of the decoded face."""
+        face = cv.imdecode(
+            np.frombuffer(message, dtype=np.uint8), cv.IMREAD_COLOR)
+        if (face is None):
+            return None
+        embedding: np.ndarray = face.reshape(-1, 3).mean(axis=0)
+        return embedding
+
+
+def _encode_face(color: Tuple[int, int, int]) -> bytes:
+    face = np.zeros((8, 8, 3), dtype=np.uint8)
+    face[...] = color
+    _, png = cv.imencode('.png', face)
+    return png.tobytes()
+
+
+class TestFaceIndex:
+    """Tests for the face_index module."""
+
+    def test_exact_match(self) -> None:
+        """Test that similar faces share an identity."""
+        index = FaceIndex(3, similarity_threshold=0.99, window_size=10)
+        first = index.add(np.array([1.0, 0.0, 0.0]))
+        second = index.add(np.array([0.0, 1.0, 0.0]))
+        third = index.add(np.array([2.0, 0.01, 0.0]))
+        assert not first.is_duplicate
+        assert not second.is_duplicate
+        assert second.identity != first.identity
+        assert third.is_duplicate
+        assert third.identity == first.identity
+        assert len(index) == 3
+
+    def test_window(self) -> None:
+        """Test that faces older than the window are forgotten."""
+        for approximate in [False, True]:
+            index = FaceIndex(
+                3, similarity_threshold=0.99, window_size=2,
+                approximate=approximate)
+            first = index.add(np.array([1.0, 0.0, 0.0]))
+            index.add(np.array([0.0, 1.0, 0.0]))
+            index.add(np.array([0.0, 0.0, 1.0]))
+            assert len(index) == 2
+            again = index.add(np.array([1.0, 0.0, 0.0]))
+            assert not again.is_duplicate
+            assert again.identity != first.identity
+
+    def test_approximate_match(self) -> None:
+        """Test that approximate mode finds near-identical faces."""
+        rng = np.random.default_rng(1)
+        embeddings = rng.standard_normal((50, 16))
+        index = FaceIndex(16, similarity_threshold=0.95, approximate=True)
+        identities = [index.add(embedding).identity
+                      for embedding in embeddings]
+        for embedding, identity in zip(embeddings, identities):
+            match = index.add(embedding + 0.001)
+            assert match.is_duplicate
+            assert match.identity == identity
+
+
+class TestProcessingClient:
+    """Tests for the processing_client module."""
+
+    def _receive(self, client: ProcessingClient, payload: bytes) -> None:
+        message = mqtt.MQTTMessage(topic=b'faces/test')
+        message.payload = payload
+        client._on_message(mqtt.Client(), {}, message)
+
+    def test_group_faces(self) -> None:
+        """Test that faces are stored under their identity."""
+        saver = MockMessageSaver()
+        deduplicator = FaceDeduplicator(
+            MockFaceEmbedder(), FaceIndex(3, 0.99, 10))
+        client = ProcessingClient('localhost', 1883, 'faces', saver,
+                                  deduplicator)
+        for color in [(255, 0, 0), (0, 255, 0), (250, 0, 0)]:
+            self._receive(client, _encode_face(color))
+        client.drain(5.0)
+        identities = [name.split('/')[0] for (_, name, _) in saver.objects]
+        assert len(identities) == 3
+        assert identities[0] != identities[1]
+        assert identities[0] == identities[2]
+
+    def test_skip_duplicates(self) -> None:
+        """Test that duplicates are not stored when skipping is enabled."""
+        saver = MockMessageSaver()
+        deduplicator = FaceDeduplicator(
+            MockFaceEmbedder(), FaceIndex(3, 0.99, 10), skip_duplicates=True)
+        client = ProcessingClient('localhost', 1883, 'faces', saver,
+                                  deduplicator)
+        for color in [(255, 0, 0), (0, 255, 0), (250, 0, 0)]:
+            self._receive(client, _encode_face(color))
+        self._receive(client, b'not an image')
+        client.drain(5.0)
+        assert len(saver.objects) == 3
+        assert '/' not in saver.objects[2][1]
+
+    def test_drain(self) -> None:
+        """Test that queued uploads are flushed on drain."""
+        saver = SlowMessageSaver()
+        client = ProcessingClient('localhost', 1883, 'faces', saver)
+        for color in [(255, 0, 0), (0, 255, 0)]:
+            self._receive(client, _encode_face(color))
+        threading.Timer(0.1, saver.release.set).start()
+        assert client.drain(5.0) == (2, 0)
+        assert len(saver.objects) == 2
+
+    def test_drain_deadline(self) -> None:
+        """Test that uploads still queued at the deadline are abandoned."""
+        saver = SlowMessageSaver()
+        client = ProcessingClient('localhost', 1883, 'faces', saver)
+        for color in [(255, 0, 0), (0, 255, 0)]:
+            self._receive(client, _encode_face(color))
+        assert client.drain(0.1) == (0, 2)
+        saver.release.set()
+
+    def test_bounded_upload_queue(self) -> None:
+        """Test that receiving blocks while the upload queue is full."""
+        saver = SlowMessageSaver()
+        client = ProcessingClient(
+            'localhost', 1883, 'faces', saver, max_queued_uploads=1)
+        self._receive(client, _encode_face((255, 0, 0)))
+        self._receive(client, _encode_face((0, 255, 0)))
+        receiver = threading.Thread(
+            target=self._receive, args=(client, _encode_face((0, 0, 255))))
+        receiver.start()
+        receiver.join(0.2)
+        assert receiver.is_alive()
+        saver.release.set()
+        receiver.join(5.0)
+        client.drain(5.0)
+        assert len(saver.objects) == 3
+
+    def test_stop(self) -> None:
+        """Test that stop only flags start to disconnect and drain."""
+        client = ProcessingClient(
+            'localhost', 1883, 'faces', MockMessageSaver())
+        calls: List[str] = []
+        for method in ['connect', 'loop_start', 'disconnect', 'loop_stop']:
+            setattr(client._client, method,
+                    lambda *args, name=method: calls.append(name))
+        client.stop()
+        assert calls == []
+        client.start(drain_timeout=1.0)
+        assert calls == ['connect', 'loop_start', 'disconnect', 'loop_stop']
+
+    def test_stop_deadline(self) -> None:
+        """Test that the drain deadline starts when stop is noticed."""
+        client = ProcessingClient(
+            'localhost', 1883, 'faces', MockMessageSaver())
+        for method in ['connect', 'loop_start', 'disconnect']:
+            setattr(client._client, method, lambda *args: None)
+        setattr(client._client, 'loop_stop', lambda *args: time.sleep(0.3))
+        drain_timeouts: List[float] = []
+        setattr(client, 'drain', drain_timeouts.append)
+        client.stop()
+        client.start(drain_timeout=1.0)
+        assert len(drain_timeouts) == 1
+        assert drain_timeouts[0] <= 0.7
+
+    def test_drop_when_stopping(self) -> None:
+        """Test that a full upload queue does not block once stopping."""
+        saver = SlowMessageSaver()
+        client = ProcessingClient(
+            'localhost', 1883, 'faces', saver, max_queued_uploads=1)
+        self._receive(client, _encode_face((255, 0, 0)))
+        self._receive(client, _encode_face((0, 255, 0)))
+        client.stop()
+        receiver = threading.Thread(
+            target=self._receive, args=(client, _encode_face((0, 0, 255))))
+        receiver.start()
+        receiver.join(1.0)
+        assert not receiver.is_alive()
+        saver.release.set()
+        assert client.drain(5.0) == (2, 1)
+        assert len(saver.objects) == 2